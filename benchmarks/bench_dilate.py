@@ -0,0 +1,52 @@
+"""Compare the old full-frame `dilate_masks` with the ROI dilation engine.
+
+    python benchmarks/bench_dilate.py --width 2048 --height 3072
+"""
+import argparse
+import sys
+from pathlib import Path
+
+import cv2
+import numpy as np
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+from timing import measure  # noqa: E402
+
+from dddetailer.mask import Mask  # noqa: E402
+
+KERNEL_SIZES = [0, 1, 2, 4, 8, 16, 32, 64, 80, 96, 128, 192, 255]
+
+
+def full_frame_dilate(array, dilation_factor):
+    if dilation_factor == 0:
+        return array
+    kernel = np.ones((dilation_factor, dilation_factor), np.uint8)
+    return cv2.dilate(array, kernel, 1)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--width", type=int, default=2048)
+    parser.add_argument("--height", type=int, default=3072)
+    parser.add_argument("--budget", type=float, default=0.5, help="seconds spent measuring each case")
+    args = parser.parse_args()
+
+    size = (args.width, args.height)
+    cx, cy = args.width // 2, args.height // 3
+    array = np.zeros((args.height, args.width), np.uint8)
+    cv2.ellipse(array, (cx, cy), (args.width // 10, args.height // 12), 0, 0, 360, 255, -1)
+    segm = Mask.from_array(array)
+    bbox = Mask.from_box((cx - args.width // 10, cy - args.height // 12, cx + args.width // 10, cy + args.height // 12), size)
+
+    print(f"canvas {args.width}x{args.height}, median times in ms")
+    print(f"{'k':>4} {'full frame':>11} {'segm roi':>9} {'bbox':>7} {'speedup':>8}")
+    for k in KERNEL_SIZES:
+        full = measure(lambda k=k: full_frame_dilate(array, k), args.budget)[0]
+        roi = measure(lambda k=k: segm.dilate(k), args.budget)[0]
+        rect = measure(lambda k=k: bbox.dilate(k), args.budget)[0]
+        print(f"{k:>4} {full:>11.3f} {roi:>9.3f} {rect:>7.3f} {full / max(roi, 1e-6):>7.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,165 @@
+"""Micro-benchmarks of the mask pipeline and preview rendering on synthetic detections.
+
+Everything here is numpy/cv2/PIL, so it runs without a GPU or the webui.
+The report is JSON; pass an earlier report to --compare to see the change
+per case, and the exit status is 1 when a case got slower than --tolerance.
+
+    python benchmarks/bench_masks.py --output before.json
+    python benchmarks/bench_masks.py --output after.json --compare before.json
+"""
+import argparse
+import json
+import platform
+import subprocess
+import sys
+from pathlib import Path
+
+import cv2
+import numpy as np
+from PIL import Image
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+from timing import measure  # noqa: E402
+
+from dddetailer.mask import (  # noqa: E402
+    Mask,
+    bitwise_and_masks,
+    bitwise_masks,
+    combine_masks,
+    create_segmasks,
+    dilate_masks,
+    group_masks,
+    is_allblack,
+    offset_masks,
+    subtract_masks,
+    transform_masks,
+    update_result_masks,
+)
+from dddetailer.preview import render_preview  # noqa: E402
+
+RESOLUTIONS = [512, 1024, 2048, 4096]
+COUNTS = [1, 10, 100]
+DILATIONS = [0, 4, 32, 128]
+QUICK = {"resolutions": [512, 2048], "counts": [1, 10], "dilations": [4, 32]}
+
+
+def synthetic_detections(side, count, seed=0):
+    """`count` elliptical segm masks and their bboxes on a `side` x `side` canvas."""
+    rng = np.random.default_rng(seed)
+    size = (side, side)
+    masks, bboxes = [], []
+    for _ in range(count):
+        rx, ry = (int(v) for v in rng.integers(side // 40 + 1, side // 8 + 2, 2))
+        cx, cy = (int(v) for v in rng.integers(0, side, 2))
+        x0, y0 = max(cx - rx, 0), max(cy - ry, 0)
+        x1, y1 = min(cx + rx + 1, side), min(cy + ry + 1, side)
+        bitmap = np.zeros((y1 - y0, x1 - x0), np.uint8)
+        cv2.ellipse(bitmap, (cx - x0, cy - y0), (rx, ry), 0, 0, 360, 1, -1)
+        masks.append(Mask((x0, y0, x1, y1), size, bitmap.astype(bool)))
+        bboxes.append(np.array([x0, y0, x1 - 1, y1 - 1], np.float32))
+    labels = ["A-person"] * count
+    scores = list(rng.uniform(0.3, 1.0, count).astype(np.float32))
+    return size, masks, [labels, bboxes, [None] * count, scores]
+
+
+def cases(resolutions, counts, dilations):
+    for side in resolutions:
+        image = Image.fromarray(np.random.default_rng(side).integers(0, 256, (side, side, 3), np.uint8))
+        array = np.zeros((side, side), np.uint8)
+        cv2.ellipse(array, (side // 2, side // 3), (side // 10, side // 8), 0, 0, 360, 255, -1)
+        yield "Mask.from_array", {"side": side}, lambda array=array: Mask.from_array(array)
+
+        for count in counts:
+            size, masks, results = synthetic_detections(side, count)
+            _, masks_b, _ = synthetic_detections(side, count, seed=1)
+            params = {"side": side, "count": count}
+            rect_masks = create_segmasks(results, size)
+            yield "create_segmasks/bbox", params, lambda r=results, s=size: create_segmasks(r, s)
+            yield "update_result_masks", params, (
+                lambda r=results, m=masks: update_result_masks([list(x) for x in r], m)
+            )
+            yield "is_allblack", params, lambda m=masks: [is_allblack(mask) for mask in m]
+            yield "offset_masks", params, lambda m=masks, s=side: offset_masks(m, s // 50, -s // 50)
+            yield "combine_masks", params, lambda m=masks: combine_masks(m)
+            pairs = list(zip(masks, masks_b))
+            yield "bitwise_and_masks", params, lambda pairs=pairs: [bitwise_and_masks(x, y) for x, y in pairs]
+            yield "subtract_masks", params, lambda pairs=pairs: [subtract_masks(x, y) for x, y in pairs]
+            yield "bitwise_masks/A&B", params, lambda m=masks, b=masks_b: bitwise_masks(m, b, "A&B")
+            yield "group_masks", params, lambda m=masks: group_masks(m, 8)
+            yield "Mask.rle", params, lambda m=masks: [mask.rle() for mask in m]
+            for max_side in (0, 1024):
+                yield "render_preview", {**params, "max_side": max_side}, (
+                    lambda r=results, m=masks, i=image, s=max_side: render_preview(i, r[0], r[3], m, s)
+                )
+            for k in dilations:
+                dparams = {**params, "dilation": k}
+                yield "dilate_masks/segm", dparams, lambda m=masks, k=k: dilate_masks(m, k)
+                yield "dilate_masks/bbox", dparams, lambda m=rect_masks, k=k: dilate_masks(m, k)
+                yield "transform_masks/segm", dparams, lambda m=masks, k=k, s=side: transform_masks(m, k, s // 50, 0)
+
+
+def case_key(case):
+    return case["name"] + "".join(f" {key}={value}" for key, value in sorted(case["params"].items()))
+
+
+def git_commit():
+    try:
+        root = Path(__file__).resolve().parents[1]
+        return subprocess.check_output(["git", "rev-parse", "HEAD"], cwd=root, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--output", help="write the JSON report here")
+    parser.add_argument("--compare", help="earlier JSON report to compare with")
+    parser.add_argument("--tolerance", type=float, default=1.25, help="slowdown ratio counted as a regression")
+    parser.add_argument("--budget", type=float, default=0.5, help="seconds spent measuring each case")
+    parser.add_argument("--quick", action="store_true", help="smaller grid: " + json.dumps(QUICK))
+    parser.add_argument("--filter", default="", help="only run cases whose name contains this")
+    args = parser.parse_args()
+
+    grid = QUICK if args.quick else {"resolutions": RESOLUTIONS, "counts": COUNTS, "dilations": DILATIONS}
+    baseline = {}
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            baseline = {case_key(case): case for case in json.load(f)["cases"]}
+
+    report = {
+        "commit": git_commit(),
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "opencv": cv2.__version__,
+        "platform": platform.platform(),
+        "budget": args.budget,
+        "cases": [],
+    }
+    regressions = 0
+    print(f"{'case':<58} {'median ms':>10} {'min ms':>9} {'runs':>5}" + (f" {'vs base':>8}" if baseline else ""))
+    for name, params, fn in cases(**grid):
+        if args.filter not in name:
+            continue
+        median, best, runs = measure(fn, args.budget)
+        case = {"name": name, "params": params, "median_ms": median, "min_ms": best, "runs": runs}
+        report["cases"].append(case)
+        line = f"{case_key(case):<58} {median:>10.3f} {best:>9.3f} {runs:>5}"
+        base = baseline.get(case_key(case))
+        if base is not None:
+            ratio = median / max(base["median_ms"], 1e-6)
+            regressed = ratio > args.tolerance
+            regressions += regressed
+            line += f" {ratio:>7.2f}x" + (" REGRESSION" if regressed else "")
+        print(line)
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+    if baseline:
+        print(f"{regressions} regression(s) over {args.tolerance}x")
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,15 @@
+"""Timing helper shared by the benchmark scripts."""
+import statistics
+import time
+
+
+def measure(fn, budget):
+    """Median and minimum time of `fn` in ms, over as many runs as fit in `budget` seconds (3 to 50)."""
+    fn()
+    times = []
+    start = time.perf_counter()
+    while len(times) < 3 or (len(times) < 50 and time.perf_counter() - start < budget):
+        t = time.perf_counter()
+        fn()
+        times.append((time.perf_counter() - t) * 1000)
+    return statistics.median(times), min(times), len(times)
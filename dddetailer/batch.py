@@ -0,0 +1,256 @@
+"""Batch detailing of image folders.
+
+The helpers here are shared by the in-process batch mode of the webui
+script (`detail_folder` in scripts/dddetailer.py) and by the command line
+client below, which sends every image to a running webui (started with
+`--api` or `--nowebui`) through its img2img API:
+
+    python -m dddetailer.batch outputs/txt2img-images detailed --model-a "bbox/mmdet_anime-face_yolov3.pth"
+
+The client writes the union of each image's detection masks to
+`output`/masks, as returned by the extension's detect API for the input
+image. With --preprocess-b the model A masks of the webui mode come from
+the image after the B pass instead, so they can differ.
+"""
+
+from __future__ import annotations
+
+import argparse
+import base64
+import glob
+import io
+import itertools
+import json
+import os
+import time
+import urllib.error
+import urllib.request
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Iterable
+
+import numpy as np
+from PIL import Image
+
+IMAGE_EXTENSIONS = (".png", ".jpg", ".jpeg", ".webp", ".bmp")
+
+
+def collect_inputs(source: str) -> tuple[str, list[str]]:
+    """Return the root and the sorted image paths of a directory (searched recursively) or a glob."""
+    if os.path.isdir(source):
+        root = source
+        paths = []
+        for dirpath, dirnames, filenames in os.walk(source):
+            dirnames.sort()
+            paths.extend(os.path.join(dirpath, name) for name in sorted(filenames))
+    else:
+        paths = sorted(glob.glob(source, recursive=True))
+        root = os.path.commonpath([os.path.dirname(os.path.abspath(path)) for path in paths]) if paths else "."
+    return root, [path for path in paths if path.lower().endswith(IMAGE_EXTENSIONS) and os.path.isfile(path)]
+
+
+def pending(root: str, paths: list[str], output_dir: str) -> list[tuple[str, str]]:
+    """Pair every input with its output path, leaving out those whose output already exists."""
+    jobs = []
+    for path in paths:
+        relpath = os.path.relpath(os.path.abspath(path), os.path.abspath(root))
+        output = os.path.join(output_dir, os.path.splitext(relpath)[0] + ".png")
+        if not os.path.exists(output):
+            jobs.append((path, output))
+    return jobs
+
+
+def prefetch(items: Iterable, load: Callable, depth: int = 4):
+    """Yield `(item, load(item))` in order, loading up to `depth` items ahead on a worker thread."""
+    items = iter(items)
+    with ThreadPoolExecutor(max_workers=1, thread_name_prefix="dddetailer-prefetch") as pool:
+        queue = deque((item, pool.submit(load, item)) for item in itertools.islice(items, max(depth, 1)))
+        while queue:
+            item, future = queue.popleft()
+            for ahead in itertools.islice(items, 1):
+                queue.append((ahead, pool.submit(load, ahead)))
+            yield item, future.result()
+
+
+class Throughput:
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.images = 0
+        self.detections = 0
+        self.skipped = 0
+        self.failed = 0
+
+    def report(self) -> str:
+        elapsed = max(time.perf_counter() - self.start, 1e-9)
+        text = f"{self.images} image(s) in {elapsed:.1f}s, {self.images / elapsed:.2f} images/s"
+        if self.detections:
+            text += f", {self.detections} detection(s), {self.detections / elapsed:.2f} detections/s"
+        if self.skipped:
+            text += f", {self.skipped} already done"
+        if self.failed:
+            text += f", {self.failed} failed"
+        return text
+
+
+def image_size(data: bytes) -> tuple[int, int]:
+    # only the header is read
+    with Image.open(io.BytesIO(data)) as image:
+        return image.size
+
+
+def decode_rle(rle: dict) -> np.ndarray:
+    """Decode the uncompressed COCO RLE of the detect API into a (height, width) bool array."""
+    height, width = rle["size"]
+    values = np.arange(len(rle["counts"])) % 2 == 1
+    return np.repeat(values, rle["counts"]).reshape(width, height).T
+
+
+def post(url: str, payload: dict, auth: str | None = None, timeout: float | None = None) -> dict:
+    headers = {"Content-Type": "application/json"}
+    if auth:
+        headers["Authorization"] = "Basic " + base64.b64encode(auth.encode()).decode()
+    request = urllib.request.Request(url, data=json.dumps(payload).encode(), headers=headers)
+    with urllib.request.urlopen(request, timeout=timeout) as response:
+        return json.load(response)
+
+
+def write_atomic(path: str, data: bytes):
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    tmp = f"{path}.{os.getpid()}.tmp"
+    with open(tmp, "wb") as f:
+        f.write(data)
+    os.replace(tmp, path)
+
+
+def script_args(args) -> list:
+    # in the order of DetectionDetailerScript.ui(); the two None are its HTML components
+    return [
+        None,
+        args.model_a,
+        args.conf_a,
+        args.dilation_a,
+        args.offset_x_a,
+        args.offset_y_a,
+        args.preprocess_b,
+        args.bitwise,
+        None,
+        args.model_b,
+        args.conf_b,
+        args.dilation_b,
+        args.offset_x_b,
+        args.offset_y_b,
+        args.mask_blur,
+        args.denoising,
+        not args.no_full_res,
+        args.padding,
+        args.cfg_scale,
+    ]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Detail a folder of images through a running webui.")
+    parser.add_argument("input", help="input directory or glob")
+    parser.add_argument("output", help="output directory; images whose output exists are skipped")
+    parser.add_argument("--url", default="http://127.0.0.1:7860")
+    parser.add_argument("--model-a", default="None")
+    parser.add_argument("--conf-a", type=float, default=30)
+    parser.add_argument("--dilation-a", type=int, default=4)
+    parser.add_argument("--offset-x-a", type=int, default=0)
+    parser.add_argument("--offset-y-a", type=int, default=0)
+    parser.add_argument("--preprocess-b", action="store_true")
+    parser.add_argument("--bitwise", default="None", choices=["None", "A&B", "A-B"])
+    parser.add_argument("--model-b", default="None")
+    parser.add_argument("--conf-b", type=float, default=30)
+    parser.add_argument("--dilation-b", type=int, default=4)
+    parser.add_argument("--offset-x-b", type=int, default=0)
+    parser.add_argument("--offset-y-b", type=int, default=0)
+    parser.add_argument("--mask-blur", type=int, default=4)
+    parser.add_argument("--denoising", type=float, default=0.4)
+    parser.add_argument("--no-full-res", action="store_true", help="do not inpaint at full resolution")
+    parser.add_argument("--padding", type=int, default=32)
+    parser.add_argument("--cfg-scale", type=float, default=7)
+    parser.add_argument("--prompt", default="")
+    parser.add_argument("--negative-prompt", default="")
+    parser.add_argument("--steps", type=int, default=20)
+    parser.add_argument("--sampler", default="Euler a")
+    parser.add_argument("--width", type=int, help="default: the width of each input image")
+    parser.add_argument("--height", type=int, help="default: the height of each input image")
+    parser.add_argument("--seed", type=int, default=-1)
+    parser.add_argument("--prefetch", type=int, default=4, help="images read and encoded ahead")
+    parser.add_argument("--no-masks", action="store_true", help="do not write the detection masks")
+    parser.add_argument("--auth", help="user:password, when the webui is started with --api-auth")
+    parser.add_argument("--timeout", type=float, default=600, help="seconds to wait for each request")
+    args = parser.parse_args(argv)
+
+    root, paths = collect_inputs(args.input)
+    jobs = pending(root, paths, args.output)
+    throughput = Throughput()
+    throughput.skipped = len(paths) - len(jobs)
+    payload = {
+        "prompt": args.prompt,
+        "negative_prompt": args.negative_prompt,
+        "steps": args.steps,
+        "sampler_name": args.sampler,
+        "cfg_scale": args.cfg_scale,
+        "seed": args.seed,
+        "denoising_strength": args.denoising,
+        "mask_blur": args.mask_blur,
+        "inpaint_full_res": not args.no_full_res,
+        "inpaint_full_res_padding": args.padding,
+        "script_name": "Detection Detailer",
+        "script_args": script_args(args),
+    }
+
+    def load(job):
+        with open(job[0], "rb") as f:
+            data = f.read()
+        width, height = image_size(data)
+        return {"init_images": [base64.b64encode(data).decode()], "width": width, "height": height}
+
+    detect_payload = {
+        "model_a": args.model_a,
+        "conf_a": args.conf_a,
+        "dilation_a": args.dilation_a,
+        "offset_x_a": args.offset_x_a,
+        "offset_y_a": args.offset_y_a,
+        "bitwise_op": args.bitwise,
+        "model_b": args.model_b,
+        "conf_b": args.conf_b,
+        "dilation_b": args.dilation_b,
+        "offset_x_b": args.offset_x_b,
+        "offset_y_b": args.offset_y_b,
+    }
+    url = args.url.rstrip("/")
+    save_masks = not args.no_masks and (args.model_a != "None" or args.model_b != "None")
+
+    for (path, output), image in prefetch(jobs, load, args.prefetch):
+        if args.width:
+            image["width"] = args.width
+        if args.height:
+            image["height"] = args.height
+        try:
+            if save_masks:
+                detect = {**detect_payload, "images": image["init_images"]}
+                detected = post(url + "/dddetailer/v1/detect", detect, args.auth, args.timeout)["images"][0]
+                mask = np.zeros((detected["height"], detected["width"]), dtype=bool)
+                for detection in detected["detections"]:
+                    mask |= decode_rle(detection["mask"])
+                buffer = io.BytesIO()
+                Image.fromarray(mask).save(buffer, format="PNG")
+                mask_path = os.path.join(args.output, "masks", os.path.relpath(output, args.output))
+                write_atomic(mask_path, buffer.getvalue())
+            result = post(url + "/sdapi/v1/img2img", {**payload, **image}, args.auth, args.timeout)
+        except (urllib.error.URLError, TimeoutError) as e:
+            # a failed or hung request skips its image; it is retried on the next run
+            throughput.failed += 1
+            print(f"[-] dddetailer: {path} failed: {e}")
+            continue
+        write_atomic(output, base64.b64decode(result["images"][0].split(",", 1)[-1]))
+        throughput.images += 1
+        print(f"{path} -> {output}")
+
+    print(f"[-] dddetailer: {throughput.report()}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,190 @@
+from __future__ import annotations
+
+import hashlib
+import io
+import os
+import threading
+import zipfile
+
+import numpy as np
+
+from dddetailer.detector import Detections
+from dddetailer.mask import Mask
+
+# bump when the entry layout changes, so stale entries are never read back
+FORMAT_VERSION = 2
+
+
+class DetectionCache:
+    """Disk cache of raw detector output, shared by every process using `root`.
+
+    Entries are keyed by the image content, the model hash and the detector
+    config. The score threshold and detection cap are not part of the key:
+    entries are meant to be detected with the config's own limits only and
+    filtered per request (`Detections.limit`), so changing the threshold,
+    dilation, offsets or bitwise mode never runs the detector again. An entry
+    made with tighter limits only serves the requests it covers
+    (`Detections.covers`).
+    Masks are stored crop-local and bit-packed in a compressed npz.
+
+    Every entry is written to a private temporary file and moved into place
+    with `os.replace`, so readers in other processes see either nothing or a
+    complete entry. A hit refreshes the entry's mtime, and once the cache grows
+    past `max_bytes` the entries with the oldest mtime are deleted first.
+    """
+
+    def __init__(self, root: str, max_bytes: int = 0):
+        self.root = os.path.abspath(root)
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._written = None
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_bytes > 0
+
+    def resize(self, max_bytes: int):
+        if max_bytes != self.max_bytes:
+            self.max_bytes = max(int(max_bytes), 0)
+            self._written = None
+
+    @staticmethod
+    def key(array: np.ndarray, *parts) -> str:
+        h = hashlib.blake2b(digest_size=20)
+        h.update(repr((FORMAT_VERSION, array.shape, str(array.dtype), *parts)).encode())
+        h.update(np.ascontiguousarray(array).data)
+        return h.hexdigest()
+
+    def get(self, key: str) -> Detections | None:
+        if not self.enabled:
+            return None
+        path = self._path(key)
+        try:
+            with np.load(path) as data:
+                detections = _load(data)
+            os.utime(path)
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError, KeyError, zipfile.BadZipFile):
+            # written by an incompatible version or damaged; drop it and detect again
+            _remove(path)
+            return None
+        return detections
+
+    def put(self, key: str, detections: Detections):
+        if not self.enabled:
+            return
+        path = self._path(key)
+        buffer = io.BytesIO()
+        np.savez_compressed(buffer, **_dump(detections))
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp, "wb") as f:
+            f.write(buffer.getbuffer())
+        os.replace(tmp, path)
+
+        with self._lock:
+            if self._written is not None:
+                self._written += buffer.tell()
+            # scanning is cheap next to detection, but not worth doing for every small entry
+            if self._written is None or self._written > self.max_bytes // 16:
+                self._written = 0
+                self.evict()
+
+    def evict(self) -> int:
+        entries = []
+        for path in self._entries():
+            try:
+                st = os.stat(path)
+            except FileNotFoundError:
+                continue
+            entries.append((st.st_mtime, st.st_size, path))
+
+        total = sum(size for _, size, _ in entries)
+        removed = 0
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            total -= size
+            removed += _remove(path)
+        return removed
+
+    def clear(self) -> int:
+        return sum(_remove(path) for path in self._entries())
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.root, key[:2], key + ".npz")
+
+    def _entries(self):
+        if not os.path.isdir(self.root):
+            return
+        for shard in os.scandir(self.root):
+            if shard.is_dir():
+                for entry in os.scandir(shard.path):
+                    if entry.name.endswith(".npz"):
+                        yield entry.path
+
+
+def _remove(path: str) -> bool:
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        # another process evicted it first
+        return False
+    return True
+
+
+def _dump(detections: Detections) -> dict:
+    n = len(detections)
+    boxes = np.zeros((n, 4), dtype=np.int32)
+    has_bitmap = np.zeros(n, dtype=bool)
+    size = (0, 0)
+    bits = []
+    for i, mask in enumerate(detections.masks):
+        if mask is None:
+            continue
+        boxes[i] = mask.box
+        size = mask.size
+        if mask.bitmap is not None:
+            has_bitmap[i] = True
+            bits.append(np.packbits(mask.bitmap, axis=None))
+    return {
+        "labels": np.asarray(detections.labels, dtype=np.int64),
+        "bboxes": np.asarray(detections.bboxes, dtype=np.float32).reshape(n, 4),
+        "scores": np.asarray(detections.scores, dtype=np.float32),
+        "has_mask": np.array([mask is not None for mask in detections.masks], dtype=bool),
+        "mask_boxes": boxes,
+        "has_bitmap": has_bitmap,
+        "size": np.array(size, dtype=np.int64),
+        "bits": np.concatenate(bits) if bits else np.zeros(0, dtype=np.uint8),
+        "limits": np.array([detections.score_thr, detections.max_per_img], dtype=np.float64),
+    }
+
+
+def _load(data) -> Detections:
+    size = tuple(int(v) for v in data["size"])
+    bits = data["bits"]
+    offset = 0
+    masks = []
+    for has_mask, box, has_bitmap in zip(data["has_mask"], data["mask_boxes"], data["has_bitmap"]):
+        if not has_mask:
+            masks.append(None)
+            continue
+        x0, y0, x1, y1 = (int(v) for v in box)
+        bitmap = None
+        if has_bitmap:
+            count = (x1 - x0) * (y1 - y0)
+            nbytes = (count + 7) // 8
+            bitmap = np.unpackbits(bits[offset : offset + nbytes], count=count).view(bool)
+            bitmap = bitmap.reshape(y1 - y0, x1 - x0)
+            offset += nbytes
+        masks.append(Mask((x0, y0, x1, y1), size, bitmap))
+    score_thr, max_per_img = data["limits"]
+    return Detections(
+        labels=data["labels"],
+        bboxes=data["bboxes"],
+        scores=data["scores"],
+        masks=masks,
+        score_thr=float(score_thr),
+        max_per_img=int(max_per_img),
+    )
@@ -0,0 +1,94 @@
+from __future__ import annotations
+
+import math
+import os
+import threading
+
+import torch
+from torch.nn import functional
+
+from dddetailer.detector import _Network, detect_with
+
+# inputs are padded up to a multiple of this, so every SD resolution maps to one of a few shapes
+BUCKET = 128
+
+
+def bucket_shape(height: int, width: int) -> tuple[int, int]:
+    return math.ceil(height / BUCKET) * BUCKET, math.ceil(width / BUCKET) * BUCKET
+
+
+class CompiledNetworks:
+    """Frozen TorchScript traces of single-stage detector networks, one per input shape.
+
+    Input batches are padded at the bottom and right up to a multiple of
+    `BUCKET`, so a handful of traces covers every image size. Padding there
+    leaves the box coordinates unchanged; mmdet then rescales them to the
+    original image as usual. Traces are saved under `root`, keyed by `key`
+    (which must identify the checkpoint and config), the input shape, the
+    device type and the torch version, and are loaded from there by later
+    sessions instead of being traced again.
+    """
+
+    def __init__(self, root: str):
+        self.root = os.path.abspath(root)
+        self._traced = {}
+        self._failed = set()
+        self._lock = threading.Lock()
+
+    def get(self, model, key: str, shape: tuple, device: torch.device):
+        name = f"{key}-{'x'.join(map(str, shape))}-{device.type}-torch{torch.__version__}"
+        with self._lock:
+            traced = self._traced.get((name, str(device)))
+            if traced is None and name not in self._failed:
+                try:
+                    traced = self._load_or_trace(model, os.path.join(self.root, name + ".pt"), shape, device)
+                except Exception as e:
+                    shape_text = "x".join(map(str, shape))
+                    print(f"[-] dddetailer: could not compile the detector for {shape_text}, using mmdet. ({e})")
+                    # only this shape falls back; other buckets may still trace
+                    self._failed.add(name)
+                    return None
+                self._traced[(name, str(device))] = traced
+            return traced
+
+    def clear(self):
+        with self._lock:
+            self._traced.clear()
+            self._failed.clear()
+
+    def _load_or_trace(self, model, path: str, shape: tuple, device: torch.device):
+        if os.path.exists(path):
+            try:
+                return torch.jit.load(path, map_location=device)
+            except (OSError, RuntimeError):
+                # damaged or written by another torch build; trace again
+                pass
+
+        example = torch.zeros(shape, device=device)
+        with torch.no_grad():
+            traced = torch.jit.trace(_Network(model).eval(), example, check_trace=False)
+            traced = torch.jit.freeze(traced.eval())
+            # the first calls of a frozen module run the graph optimizations
+            traced(example)
+        os.makedirs(self.root, exist_ok=True)
+        tmp = f"{path}.{os.getpid()}.tmp"
+        torch.jit.save(traced, tmp)
+        os.replace(tmp, path)
+        return traced
+
+
+def detect(model, networks: CompiledNetworks, key: str, images: list, batch_size: int = 1) -> list:
+    """Same as `dddetailer.detector.detect`, with the network run by bucketed traces.
+
+    Input shapes that cannot be traced run the model's own network instead.
+    """
+
+    def network(inputs):
+        batch, channels, height, width = inputs.shape
+        padded_height, padded_width = bucket_shape(height, width)
+        traced = networks.get(model, key, (batch, channels, padded_height, padded_width), inputs.device)
+        if traced is None:
+            return _Network(model)(inputs)
+        return traced(functional.pad(inputs, (0, padded_width - width, 0, padded_height - height)))
+
+    return detect_with(model, network, images, batch_size)
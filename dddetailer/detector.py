@@ -0,0 +1,341 @@
+from __future__ import annotations
+
+import os
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future
+from contextlib import contextmanager
+from dataclasses import dataclass
+
+import numpy as np
+import torch
+
+from dddetailer.mask import Mask
+
+
+@dataclass
+class Detections:
+    """Detector output for one image.
+
+    `masks` holds a crop-local `Mask` per instance, or None for every
+    instance of a bbox-only model. `score_thr` and `max_per_img` are the
+    limits the detector ran with (0 for none): the detections are complete
+    for any stricter limits, see `covers`.
+    """
+
+    labels: np.ndarray
+    bboxes: np.ndarray
+    scores: np.ndarray
+    masks: list
+    score_thr: float = 0.0
+    max_per_img: int = 0
+
+    def __len__(self):
+        return len(self.scores)
+
+    @classmethod
+    def from_instances(cls, instances, score_thr: float = 0.0, max_per_img: int = 0) -> Detections:
+        # drop low scores on the device, so their masks are never copied to the host
+        if score_thr > 0:
+            instances = instances[instances.scores > score_thr]
+        bboxes = instances.bboxes.cpu().numpy()
+        masks = [None] * len(bboxes)
+        if "masks" in instances:
+            masks = [Mask.from_array(mask) for mask in instances.masks.cpu().numpy()]
+        return cls(
+            labels=instances.labels.cpu().numpy(),
+            bboxes=bboxes,
+            scores=instances.scores.cpu().numpy(),
+            masks=masks,
+            score_thr=score_thr,
+            max_per_img=max_per_img,
+        )
+
+    def covers(self, score_thr: float, max_per_img: int) -> bool:
+        return score_thr >= self.score_thr and (self.max_per_img == 0 or 0 < max_per_img <= self.max_per_img)
+
+    def limit(self, score_thr: float, max_per_img: int) -> Detections:
+        """Keep the instances scoring above `score_thr`, at most `max_per_img` of the best ones."""
+        keep = np.flatnonzero(self.scores > score_thr)
+        if max_per_img > 0 and len(keep) > max_per_img:
+            keep = np.sort(keep[np.argsort(-self.scores[keep], kind="stable")[:max_per_img]])
+        if len(keep) == len(self):
+            return self
+        return Detections(
+            labels=self.labels[keep],
+            bboxes=self.bboxes[keep],
+            scores=self.scores[keep],
+            masks=[self.masks[i] for i in keep],
+            score_thr=score_thr,
+            max_per_img=max_per_img,
+        )
+
+    def resize(self, src_size, size) -> Detections:
+        """Map detections made on a `src_size` (width, height) copy of an image back onto `size`.
+
+        Mask pixels are only resampled inside each mask's box.
+        """
+        if tuple(src_size) == tuple(size):
+            return self
+        scale = np.array([size[0] / src_size[0], size[1] / src_size[1]] * 2, dtype=np.float32)
+        return Detections(
+            labels=self.labels,
+            bboxes=self.bboxes * scale,
+            scores=self.scores,
+            masks=[mask.resize(size) if mask is not None else None for mask in self.masks],
+            score_thr=self.score_thr,
+            max_per_img=self.max_per_img,
+        )
+
+
+class DetectorCache:
+    """Process-wide LRU cache of initialized mmdet detectors.
+
+    Entries are keyed by (checkpoint path, checkpoint mtime, device), so a
+    replaced checkpoint file is loaded again instead of served stale. A model
+    is loaded outside the cache lock, behind a per-key future, so lookups of
+    other models never wait for it and concurrent lookups of the same model
+    share one load. Models are used through `lease`: an evicted model is moved
+    to the CPU and the CUDA cache is emptied once its last lease ends, so its
+    device memory is given back without pulling it from under a running
+    detection.
+    """
+
+    def __init__(self, max_size: int = 2):
+        self.max_size = max_size
+        self._models = OrderedDict()
+        self._leases = {}
+        self._evicted = set()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._models)
+
+    @contextmanager
+    def lease(self, config: str, checkpoint: str, device: str):
+        """Yield the model of `checkpoint`, kept on its device until the block ends."""
+        path = os.path.abspath(checkpoint)
+        key = (path, os.path.getmtime(path), str(device))
+
+        released = []
+        with self._lock:
+            future = self._models.get(key)
+            loading = future is None
+            if loading:
+                stale = [k for k in self._models if k[0] == path and k[1] != key[1]]
+                released = self._drop([self._models.pop(k) for k in stale])
+                future = self._models[key] = Future()
+            else:
+                self._models.move_to_end(key)
+            self._leases[future] = self._leases.get(future, 0) + 1
+        try:
+            _release(released)
+            if loading:
+                self._load_into(future, key, config, checkpoint, device)
+            yield future.result()
+        finally:
+            with self._lock:
+                self._leases[future] -= 1
+                released = []
+                if self._leases[future] == 0:
+                    del self._leases[future]
+                    if future in self._evicted:
+                        self._evicted.discard(future)
+                        released = [future]
+            _release(released)
+
+    def resize(self, max_size: int):
+        with self._lock:
+            self.max_size = max(int(max_size), 1)
+            released = self._evict()
+        _release(released)
+
+    def clear(self) -> int:
+        with self._lock:
+            count = len(self._models)
+            released = self._drop(list(self._models.values()))
+            self._models.clear()
+        _release(released)
+        return count
+
+    def _load_into(self, future: Future, key, config: str, checkpoint: str, device: str):
+        try:
+            model = self._load(config, checkpoint, device)
+        except BaseException as e:
+            with self._lock:
+                if self._models.get(key) is future:
+                    del self._models[key]
+            future.set_exception(e)
+            raise
+        future.set_result(model)
+        with self._lock:
+            released = self._evict()
+        _release(released)
+
+    def _load(self, config: str, checkpoint: str, device: str):
+        from mmdet.apis import init_detector
+
+        return init_detector(config, checkpoint, device=device)
+
+    def _evict(self) -> list:
+        evicted = []
+        while len(self._models) > self.max_size:
+            evicted.append(self._models.popitem(last=False)[1])
+        return self._drop(evicted)
+
+    def _drop(self, futures: list) -> list:
+        # models still leased are released by their last lease instead
+        leased = [f for f in futures if f in self._leases]
+        self._evicted.update(leased)
+        return [f for f in futures if f not in self._leases]
+
+
+def _release(futures: list):
+    # a model evicted while it is still loading is only handed to the callers waiting for it
+    models = [f.result() for f in futures if f.done() and f.exception() is None]
+    if not models:
+        return
+    for model in models:
+        model.to("cpu")
+    if torch.cuda.is_available():
+        torch.cuda.empty_cache()
+
+
+_limits_lock = threading.Lock()
+
+
+@contextmanager
+def limits(model, score_thr: float, max_per_img: int = 0):
+    """Run `model` with at least `score_thr` and at most `max_per_img` instances per image (0: no cap).
+
+    The limits go into the test_cfg of the model's heads, so for bbox_head
+    models instances below them are never decoded or upsampled. Mask2Former
+    upsamples the masks of all its queries before its panoptic_fusion_head
+    applies max_per_image, and has no score threshold of its own: for it the
+    cap only saves the host copies, and the score cut is done by
+    `Detections.from_instances`. The cached model is reconfigured in place and
+    restored afterwards, and calls on the same model are serialized meanwhile.
+    The config's own limits are only ever tightened.
+    """
+    with _limits_lock:
+        lock = getattr(model, "_dd_limits_lock", None)
+        if lock is None:
+            lock = model._dd_limits_lock = threading.Lock()
+    with lock:
+        changed = []
+        for name in ("bbox_head", "panoptic_fusion_head"):
+            cfg = getattr(getattr(model, name, None), "test_cfg", None)
+            if cfg is None:
+                continue
+            if "score_thr" in cfg:
+                changed.append((cfg, "score_thr", cfg["score_thr"]))
+                cfg["score_thr"] = max(cfg["score_thr"], score_thr)
+            if max_per_img > 0:
+                # Mask2Former keeps max_per_image (default 100) of its query masks, the others max_per_img
+                key = "max_per_image" if name == "panoptic_fusion_head" else "max_per_img"
+                default = 100 if name == "panoptic_fusion_head" else None
+                current = cfg.get(key, default)
+                if current is not None:
+                    changed.append((cfg, key, cfg.get(key)))
+                    cfg[key] = min(current, max_per_img)
+        try:
+            yield
+        finally:
+            for cfg, key, value in reversed(changed):
+                if value is None:
+                    cfg.pop(key, None)
+                else:
+                    cfg[key] = value
+
+
+def _test_pipeline(model):
+    pipeline = getattr(model, "_dd_test_pipeline", None)
+    if pipeline is None:
+        from mmcv.transforms import Compose
+        from mmdet.utils import get_test_pipeline_cfg
+
+        cfg = get_test_pipeline_cfg(model.cfg.copy())
+        cfg[0].type = "mmdet.LoadImageFromNDArray"
+        pipeline = Compose(cfg)
+        model._dd_test_pipeline = pipeline
+    return pipeline
+
+
+def input_size(model) -> int:
+    """Longest side the test pipeline of `model` resizes images to, or 0 if it does not resize."""
+    from mmdet.utils import get_test_pipeline_cfg
+
+    for step in get_test_pipeline_cfg(model.cfg.copy()):
+        if str(step.get("type", "")).endswith("Resize") and "scale" in step:
+            scale = step["scale"]
+            return max(scale) if isinstance(scale, (tuple, list)) else int(scale)
+    return 0
+
+
+def detect(model, images: list, batch_size: int = 1) -> list:
+    """Run `model` on a list of HWC uint8 arrays, `batch_size` images per forward pass.
+
+    The data preprocessor pads every chunk to a common shape and the
+    predictions are rescaled back to each image, so the result is the
+    `pred_instances` of every image, in order, as `inference_detector` would
+    return them one by one.
+    """
+    from mmengine.dataset import pseudo_collate
+
+    pipeline = _test_pipeline(model)
+    batch_size = max(int(batch_size), 1)
+    outputs = []
+    for start in range(0, len(images), batch_size):
+        chunk = images[start : start + batch_size]
+        data = pseudo_collate([pipeline({"img": img, "img_id": start + i}) for i, img in enumerate(chunk)])
+        with torch.no_grad():
+            results = model.test_step(data)
+        outputs.extend(result.pred_instances for result in results)
+    return outputs
+
+
+def single_stage(model) -> bool:
+    """Whether the network of `model` can be swapped out by `detect_with`.
+
+    That holds for single-stage detectors, whose network is plain
+    convolutions ending in a dense head, but not for Mask2Former.
+    """
+    head = getattr(model, "bbox_head", None)
+    return head is not None and hasattr(head, "prior_generator") and not hasattr(model, "roi_head")
+
+
+class _Network(torch.nn.Module):
+    """The network of a single-stage detector, returning its head outputs as one flat tuple."""
+
+    def __init__(self, model):
+        super().__init__()
+        self.model = model
+
+    def forward(self, inputs):
+        return tuple(t for group in self.model._forward(inputs) for t in group)
+
+
+def detect_with(model, network, images: list, batch_size: int = 1) -> list:
+    """Same as `detect`, with the network of a single-stage `model` replaced by `network`.
+
+    `network` maps a preprocessed input batch to the flat head outputs, as
+    `_Network` does. Preprocessing, box decoding, NMS and rescaling are still
+    done by the mmdet model, so the `pred_instances` match those of `detect`.
+    """
+    from mmengine.dataset import pseudo_collate
+
+    pipeline = _test_pipeline(model)
+    head = model.bbox_head
+    levels = len(head.prior_generator.strides)
+    batch_size = max(int(batch_size), 1)
+    outputs = []
+    for start in range(0, len(images), batch_size):
+        chunk = images[start : start + batch_size]
+        data = pseudo_collate([pipeline({"img": img, "img_id": start + i}) for i, img in enumerate(chunk)])
+        with torch.no_grad():
+            data = model.data_preprocessor(data, False)
+            maps = list(network(data["inputs"]))
+            groups = [maps[i : i + levels] for i in range(0, len(maps), levels)]
+            metas = [sample.metainfo for sample in data["data_samples"]]
+            outputs.extend(head.predict_by_feat(*groups, batch_img_metas=metas, rescale=True))
+    return outputs
@@ -0,0 +1,368 @@
+from __future__ import annotations
+
+import math
+
+import cv2
+import numpy as np
+from PIL import Image
+
+# above this kernel size a running box sum beats cv2.dilate, whose cost grows with the kernel
+LARGE_KERNEL = 80
+
+
+class Mask:
+    """A detection mask on a `size` (width, height) canvas, stored crop-local.
+
+    `box` is the half-open pixel rectangle (x0, y0, x1, y1) covered by the
+    mask, clipped to the canvas. When `bitmap` is None the mask is the solid
+    rectangle itself, so bbox detections stay plain coordinates until pixels
+    are needed. Otherwise `bitmap` is a boolean array of the box's shape.
+    Every operation works inside the box; the full canvas is only allocated
+    by `to_array` and `to_image`.
+    """
+
+    __slots__ = ("box", "size", "bitmap")
+
+    def __init__(self, box, size, bitmap=None):
+        width, height = size
+        x0, y0, x1, y1 = (int(v) for v in box)
+        cx0, cy0 = min(max(x0, 0), width), min(max(y0, 0), height)
+        cx1, cy1 = max(min(x1, width), cx0), max(min(y1, height), cy0)
+        if bitmap is not None and (cx0, cy0, cx1, cy1) != (x0, y0, x1, y1):
+            bitmap = bitmap[cy0 - y0 : cy0 - y0 + cy1 - cy0, cx0 - x0 : cx0 - x0 + cx1 - cx0]
+        self.box = (cx0, cy0, cx1, cy1)
+        self.size = (width, height)
+        self.bitmap = bitmap
+
+    @classmethod
+    def from_box(cls, bbox, size):
+        # same pixels as cv2.rectangle(mask, (int(x0), int(y0)), (int(x1), int(y1)), 255, -1)
+        x0, y0, x1, y1 = (int(v) for v in bbox)
+        return cls((x0, y0, x1 + 1, y1 + 1), size)
+
+    @classmethod
+    def from_array(cls, array):
+        array = np.asarray(array)
+        height, width = array.shape[:2]
+        x, y, w, h = cv2.boundingRect(array.astype(np.uint8, copy=False))
+        bitmap = array[y : y + h, x : x + w].astype(bool)
+        return cls((x, y, x + w, y + h), (width, height), bitmap)
+
+    @property
+    def is_rect(self) -> bool:
+        return self.bitmap is None
+
+    @property
+    def area(self) -> int:
+        x0, y0, x1, y1 = self.box
+        if self.bitmap is None:
+            return (x1 - x0) * (y1 - y0)
+        return int(np.count_nonzero(self.bitmap))
+
+    def tight_box(self):
+        """Return the smallest box containing every pixel of the mask."""
+        if self.bitmap is None or self.is_empty():
+            return self.box
+        x, y, w, h = cv2.boundingRect(self.bitmap.view(np.uint8))
+        return self.box[0] + x, self.box[1] + y, self.box[0] + x + w, self.box[1] + y + h
+
+    def is_empty(self) -> bool:
+        x0, y0, x1, y1 = self.box
+        if x0 == x1 or y0 == y1:
+            return True
+        return self.bitmap is not None and not self.bitmap.any()
+
+    def crop(self, box) -> np.ndarray:
+        """Return this mask's pixels inside `box` as a boolean array; pixels off the canvas are False."""
+        x0, y0, x1, y1 = box
+        out = np.zeros((y1 - y0, x1 - x0), dtype=bool)
+        mx0, my0, mx1, my1 = self.box
+        ix0, iy0 = max(x0, mx0), max(y0, my0)
+        ix1, iy1 = min(x1, mx1), min(y1, my1)
+        if ix0 < ix1 and iy0 < iy1:
+            region = out[iy0 - y0 : iy1 - y0, ix0 - x0 : ix1 - x0]
+            if self.bitmap is None:
+                region[...] = True
+            else:
+                region[...] = self.bitmap[iy0 - my0 : iy1 - my0, ix0 - mx0 : ix1 - mx0]
+        return out
+
+    def dilate(self, dilation_factor: int) -> Mask:
+        return self.transform(dilation_factor, 0, 0)
+
+    def offset(self, offset_x: int, offset_y: int) -> Mask:
+        return self.transform(0, offset_x, offset_y)
+
+    def transform(self, dilation_factor: int, offset_x: int, offset_y: int) -> Mask:
+        """Dilate the mask, then move it right by `offset_x` and up by `offset_y`.
+
+        Pixels moved off the canvas are clipped, not wrapped around, and only
+        the part of the mask that stays on the canvas is dilated.
+        """
+        if (dilation_factor <= 1 and offset_x == 0 and offset_y == 0) or self.is_empty():
+            return self
+        # a k x k kernel anchored at its center grows a pixel by (k-1)//2 before and k//2 after
+        before, after = ((dilation_factor - 1) // 2, dilation_factor // 2) if dilation_factor > 1 else (0, 0)
+        dx, dy = offset_x, -offset_y
+        width, height = self.size
+        x0, y0, x1, y1 = self.box
+        grown = _intersect_box((x0 - before, y0 - before, x1 + after, y1 + after), (0, 0, width, height))
+        keep = _intersect_box(grown, (-dx, -dy, width - dx, height - dy))
+        target = (keep[0] + dx, keep[1] + dy, keep[2] + dx, keep[3] + dy)
+        if self.is_rect or keep[0] == keep[2] or keep[1] == keep[3]:
+            return Mask(target, self.size)
+
+        if dilation_factor <= 1:
+            return Mask(target, self.size, self.crop(keep))
+        # an output pixel reads input pixels up to k//2 before and (k-1)//2 after it,
+        # and only the pixels inside self.box can be set
+        reach = _intersect_box((keep[0] - after, keep[1] - after, keep[2] + before, keep[3] + before), self.box)
+        source = keep if reach[0] == reach[2] or reach[1] == reach[3] else _union_box(keep, reach)
+        dilated = dilate_bitmap(self.crop(source), dilation_factor)
+        sx, sy = keep[0] - source[0], keep[1] - source[1]
+        bitmap = dilated[sy : sy + keep[3] - keep[1], sx : sx + keep[2] - keep[0]]
+        return Mask(target, self.size, bitmap)
+
+    def resize(self, size) -> Mask:
+        """Return the mask scaled onto a `size` (width, height) canvas.
+
+        Only the pixels inside the box are resampled; the new box is the old
+        one scaled outwards to whole pixels.
+        """
+        width, height = size
+        if (width, height) == self.size:
+            return self
+        sx, sy = width / self.size[0], height / self.size[1]
+        x0, y0, x1, y1 = self.box
+        box = (math.floor(x0 * sx), math.floor(y0 * sy), math.ceil(x1 * sx), math.ceil(y1 * sy))
+        if self.bitmap is None:
+            return Mask(box, size)
+        w, h = box[2] - box[0], box[3] - box[1]
+        if self.is_empty() or w == 0 or h == 0:
+            return Mask(box, size, np.zeros((h, w), dtype=bool))
+        scaled = cv2.resize(self.bitmap.view(np.uint8) * 255, (w, h), interpolation=cv2.INTER_LINEAR)
+        return Mask(box, size, scaled > 127)
+
+    def rle(self) -> dict:
+        """Return the mask as uncompressed COCO RLE: column-major run lengths over the canvas, zeros first.
+
+        The runs are computed from the box alone, so the canvas is never allocated.
+        """
+        width, height = self.size
+        x0, y0, x1, y1 = self.box
+        if self.is_empty():
+            return {"size": [height, width], "counts": [width * height]}
+        # every column of the box, padded with a background pixel above and below
+        columns = np.zeros((x1 - x0, y1 - y0 + 2), dtype=bool)
+        columns[:, 1:-1] = True if self.bitmap is None else self.bitmap.T
+        change = np.flatnonzero(columns[:, 1:] != columns[:, :-1])
+        column, row = np.divmod(change, y1 - y0 + 1)
+        positions = (x0 + column) * height + y0 + row
+        # a run that ends at the bottom of a column and goes on at the top of the next one is a single run
+        joined = np.flatnonzero(positions[1:-1:2] == positions[2::2])
+        positions = np.delete(positions, np.concatenate([2 * joined + 1, 2 * joined + 2]))
+        counts = np.diff(np.concatenate([[0], positions, [width * height]]))
+        if counts[-1] == 0:
+            counts = counts[:-1]
+        return {"size": [height, width], "counts": counts.tolist()}
+
+    def to_array(self) -> np.ndarray:
+        width, height = self.size
+        return self.crop((0, 0, width, height))
+
+    def to_image(self) -> Image.Image:
+        width, height = self.size
+        x0, y0, x1, y1 = self.box
+        array = np.zeros((height, width), dtype=np.uint8)
+        array[y0:y1, x0:x1] = 255 if self.bitmap is None else self.bitmap.view(np.uint8) * 255
+        return Image.fromarray(array)
+
+    def __array__(self, dtype=None, copy=None):
+        array = np.asarray(self.to_image())
+        if dtype is not None:
+            array = array.astype(dtype)
+        return array
+
+
+def dilate_bitmap(bitmap: np.ndarray, dilation_factor: int) -> np.ndarray:
+    """Dilate a boolean bitmap with a `dilation_factor` square kernel, like `cv2.dilate(bitmap, np.ones((k, k)))`.
+
+    Small kernels use OpenCV's separable rectangle dilation. Large kernels
+    count foreground pixels under the kernel with an unnormalized box filter,
+    whose cost does not depend on the kernel size.
+    """
+    if dilation_factor <= 1:
+        return bitmap
+    src = bitmap.view(np.uint8)
+    if dilation_factor <= LARGE_KERNEL:
+        kernel = cv2.getStructuringElement(cv2.MORPH_RECT, (dilation_factor, dilation_factor))
+        return cv2.dilate(src, kernel).view(bool)
+    ddepth = cv2.CV_16U if dilation_factor * dilation_factor <= np.iinfo(np.uint16).max else cv2.CV_32F
+    counts = cv2.boxFilter(
+        src, ddepth, (dilation_factor, dilation_factor), normalize=False, borderType=cv2.BORDER_CONSTANT
+    )
+    return counts > 0
+
+
+def _intersect_box(box1, box2):
+    x0, y0 = max(box1[0], box2[0]), max(box1[1], box2[1])
+    x1, y1 = max(min(box1[2], box2[2]), x0), max(min(box1[3], box2[3]), y0)
+    return x0, y0, x1, y1
+
+
+def _union_box(box1, box2):
+    return min(box1[0], box2[0]), min(box1[1], box2[1]), max(box1[2], box2[2]), max(box1[3], box2[3])
+
+
+def create_segmasks(results, size):
+    bboxes = results[1]
+    segms = results[2]
+    segmasks = []
+    for i in range(len(segms)):
+        if segms[i] is None:
+            mask = Mask.from_box(bboxes[i], size)
+        elif isinstance(segms[i], Mask):
+            mask = segms[i]
+        else:
+            mask = Mask.from_array(segms[i])
+        segmasks.append(mask)
+
+    return segmasks
+
+
+def update_result_masks(results, masks):
+    for i in range(len(masks)):
+        results[2][i] = masks[i]
+    return results
+
+
+def is_allblack(mask):
+    return mask.is_empty()
+
+
+def bitwise_and_masks(mask1, mask2):
+    box = _intersect_box(mask1.box, mask2.box)
+    if mask1.is_rect and mask2.is_rect:
+        return Mask(box, mask1.size)
+    return Mask(box, mask1.size, mask1.crop(box) & mask2.crop(box))
+
+
+def subtract_masks(mask1, mask2):
+    box = mask1.box
+    other = mask2.crop(box)
+    if not other.any():
+        return mask1
+    return Mask(box, mask1.size, mask1.crop(box) & ~other)
+
+
+def dilate_masks(masks, dilation_factor, iter=1):
+    return transform_masks(masks, dilation_factor, 0, 0)
+
+
+def offset_masks(masks, offset_x, offset_y):
+    return transform_masks(masks, 0, offset_x, offset_y)
+
+
+def transform_masks(masks, dilation_factor, offset_x, offset_y):
+    if dilation_factor <= 1 and offset_x == 0 and offset_y == 0:
+        return masks
+    return [mask.transform(dilation_factor, offset_x, offset_y) for mask in masks]
+
+
+def combine_masks(masks):
+    size = masks[0].size
+    masks = [mask for mask in masks if not mask.is_empty()]
+    if len(masks) == 0:
+        return Mask((0, 0, 0, 0), size)
+    if len(masks) == 1:
+        return masks[0]
+    box = (
+        min(mask.box[0] for mask in masks),
+        min(mask.box[1] for mask in masks),
+        max(mask.box[2] for mask in masks),
+        max(mask.box[3] for mask in masks),
+    )
+    bitmap = np.zeros((box[3] - box[1], box[2] - box[0]), dtype=bool)
+    for mask in masks:
+        x0, y0, x1, y1 = mask.box
+        region = bitmap[y0 - box[1] : y1 - box[1], x0 - box[0] : x1 - box[0]]
+        if mask.bitmap is None:
+            region[...] = True
+        else:
+            region |= mask.bitmap
+
+    return Mask(box, size, bitmap)
+
+
+def bitwise_masks(masks, masks_b, op):
+    """Apply `op` ("A&B" or "A-B") between each mask and the union of `masks_b` in one pass.
+
+    The union is built once and the overlap test is vectorized over all
+    boxes. The pixel operation itself stays a loop over the overlapping
+    masks: each one only slices its own box, which measured several times
+    faster than gathering every mask's pixels into one flat array.
+
+    Returns the resulting masks that are not empty and their indices in `masks`.
+    """
+    if op not in ("A&B", "A-B") or len(masks) == 0:
+        return masks, list(range(len(masks)))
+
+    combined = combine_masks(masks_b)
+    boxes = np.array([mask.box for mask in masks], dtype=np.int64).reshape(-1, 4)
+    bx0, by0, bx1, by1 = combined.box
+    overlaps = (boxes[:, 0] < bx1) & (boxes[:, 2] > bx0) & (boxes[:, 1] < by1) & (boxes[:, 3] > by0)
+
+    out = []
+    keep = []
+    for i in range(len(masks)):
+        if op == "A&B":
+            if not overlaps[i]:
+                continue
+            mask = bitwise_and_masks(masks[i], combined)
+        else:
+            mask = subtract_masks(masks[i], combined) if overlaps[i] else masks[i]
+        if not mask.is_empty():
+            out.append(mask)
+            keep.append(i)
+    return out, keep
+
+
+def group_masks(masks, padding=0):
+    """Split mask indices into groups whose `padding`-expanded boxes do not overlap each other.
+
+    The groups are a greedy (Welsh-Powell) colouring of the overlap graph, so
+    every group can be inpainted in one pass with the union of its masks.
+    """
+    if len(masks) == 0:
+        return []
+    boxes = np.array([mask.box for mask in masks], dtype=np.int64).reshape(-1, 4)
+    boxes += np.array([-padding, -padding, padding, padding])
+    overlap = (
+        (boxes[:, None, 0] < boxes[None, :, 2])
+        & (boxes[:, None, 2] > boxes[None, :, 0])
+        & (boxes[:, None, 1] < boxes[None, :, 3])
+        & (boxes[:, None, 3] > boxes[None, :, 1])
+    )
+    np.fill_diagonal(overlap, False)
+
+    colors = np.full(len(masks), -1)
+    for i in np.argsort(-overlap.sum(axis=1), kind="stable"):
+        used = set(colors[overlap[i]].tolist())
+        color = 0
+        while color in used:
+            color += 1
+        colors[i] = color
+
+    groups = [np.flatnonzero(colors == color).tolist() for color in range(colors.max() + 1)]
+    return sorted(groups)
+
+
+def select_results(results, indices):
+    return [[result[i] for i in indices] for result in results]
+
+
+def drop_empty_masks(results, masks):
+    keep = [i for i, mask in enumerate(masks) if not mask.is_empty()]
+    if len(keep) == len(masks):
+        return results, masks
+    return select_results(results, keep), [masks[i] for i in keep]
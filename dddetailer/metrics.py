@@ -0,0 +1,211 @@
+from __future__ import annotations
+
+import contextvars
+import functools
+import json
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+
+def peak_rss_mb() -> float | None:
+    """Peak resident memory of the process so far, in MiB."""
+    if resource is not None:
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # bytes on macOS, KiB elsewhere
+        return peak / (1 << 20) if sys.platform == "darwin" else peak / 1024
+    try:
+        import psutil
+    except ImportError:
+        return None
+    info = psutil.Process().memory_info()
+    return getattr(info, "peak_wset", info.rss) / (1 << 20)
+
+
+def peak_device_mb() -> float | None:
+    """Peak CUDA memory allocated by torch in this process, in MiB.
+
+    The peak is process-wide and never reset here: other extensions and the
+    webui itself read and reset the same statistic.
+    """
+    try:
+        import torch
+    except ImportError:
+        return None
+    if not torch.cuda.is_available() or not torch.cuda.is_initialized():
+        return None
+    return torch.cuda.max_memory_allocated() / (1 << 20)
+
+
+class Counters:
+    """Cumulative per-stage totals over every run of the process, for scraping."""
+
+    def __init__(self):
+        self._stages = {}
+        self._runs = 0
+        self._lock = threading.Lock()
+
+    def add(self, name: str, wall: float, cpu: float):
+        with self._lock:
+            totals = self._stages.setdefault(name, [0, 0.0, 0.0])
+            totals[0] += 1
+            totals[1] += wall
+            totals[2] += cpu
+
+    def add_run(self):
+        with self._lock:
+            self._runs += 1
+
+    def prometheus(self) -> str:
+        """The counters in the Prometheus text exposition format."""
+        with self._lock:
+            stages = {name: list(totals) for name, totals in self._stages.items()}
+            runs = self._runs
+        lines = [
+            "# TYPE dddetailer_runs_total counter",
+            f"dddetailer_runs_total {runs}",
+            "# TYPE dddetailer_stage_calls_total counter",
+            *(f'dddetailer_stage_calls_total{{stage="{name}"}} {t[0]}' for name, t in stages.items()),
+            "# TYPE dddetailer_stage_seconds_total counter",
+            *(f'dddetailer_stage_seconds_total{{stage="{name}"}} {t[1]:.6f}' for name, t in stages.items()),
+            "# TYPE dddetailer_stage_cpu_seconds_total counter",
+            *(f'dddetailer_stage_cpu_seconds_total{{stage="{name}"}} {t[2]:.6f}' for name, t in stages.items()),
+        ]
+        rss = peak_rss_mb()
+        if rss is not None:
+            lines += ["# TYPE dddetailer_peak_rss_bytes gauge", f"dddetailer_peak_rss_bytes {int(rss * (1 << 20))}"]
+        return "\n".join(lines) + "\n"
+
+
+counters = Counters()
+
+
+class Run:
+    """Per-stage timings of one detail run.
+
+    Every stage records its wall time, the CPU time of the whole process
+    (detection also runs on worker threads) and the peak RSS and CUDA memory
+    at its end. Those peaks are process-wide high-water marks, so each stage
+    also records how far they rose while it ran (`*_peak_rise_mb`, the largest
+    rise of its calls): a stage that did not set a new high-water mark shows
+    0 there. Stages nest and may overlap across threads, so their times and
+    rises do not add up to the run's.
+    """
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.stages = {}
+        self._lock = threading.Lock()
+
+    def add(self, name: str, wall: float, cpu: float, peaks_before: tuple = (None, None)):
+        """Record one call of stage `name`; `peaks_before` are the (RSS, CUDA) peaks when it started."""
+        peaks = (peak_rss_mb(), peak_device_mb())
+        with self._lock:
+            stage = self.stages.setdefault(
+                name,
+                {
+                    "count": 0,
+                    "wall_s": 0.0,
+                    "cpu_s": 0.0,
+                    "rss_peak_mb": None,
+                    "rss_peak_rise_mb": None,
+                    "device_peak_mb": None,
+                    "device_peak_rise_mb": None,
+                },
+            )
+            stage["count"] += 1
+            stage["wall_s"] += wall
+            stage["cpu_s"] += cpu
+            for kind, peak, before in zip(("rss", "device"), peaks, peaks_before):
+                stage[f"{kind}_peak_mb"] = _max(stage[f"{kind}_peak_mb"], peak)
+                if peak is not None and before is not None:
+                    stage[f"{kind}_peak_rise_mb"] = _max(stage[f"{kind}_peak_rise_mb"], peak - before)
+
+    def summary(self) -> dict:
+        with self._lock:
+            stages = {name: dict(stage) for name, stage in self.stages.items()}
+        return {"wall_s": time.perf_counter() - self.start, "stages": stages}
+
+    def snapshot(self) -> dict:
+        """The per-stage counts and wall times so far, to pass to `infotext` later."""
+        with self._lock:
+            return {name: (stage["count"], stage["wall_s"]) for name, stage in self.stages.items()}
+
+    def infotext(self, since: dict | None = None) -> str:
+        """Short per-stage wall times for `extra_generation_params`, only those after the `since` snapshot."""
+        since = since or {}
+        with self._lock:
+            stages = [(name, stage["count"], stage["wall_s"]) for name, stage in self.stages.items()]
+        return ", ".join(
+            f"{name} {wall - since.get(name, (0, 0.0))[1]:.2f}s"
+            for name, count, wall in stages
+            if count > since.get(name, (0, 0.0))[0]
+        )
+
+    def log(self, path: str, **extra):
+        """Append the summary to the JSON lines file at `path`."""
+        record = {"time": time.time(), **extra, **self.summary()}
+        with open(path, "a", encoding="utf-8") as f:
+            f.write(json.dumps(record) + "\n")
+
+
+# the run of the current request; worker threads see it through `bind`
+current: contextvars.ContextVar[Run | None] = contextvars.ContextVar("dddetailer_run", default=None)
+
+
+@contextmanager
+def running(run: Run):
+    """Make `run` the current run of this context until the block ends."""
+    token = current.set(run)
+    try:
+        yield run
+    finally:
+        current.reset(token)
+
+
+def bind(fn):
+    """Wrap `fn` to run in a copy of the current context, for submitting to another thread."""
+    return functools.partial(contextvars.copy_context().run, fn)
+
+
+@contextmanager
+def stage(name: str):
+    """Time a stage into the current run, if any, and into the process counters."""
+    run = current.get()
+    peaks = (peak_rss_mb(), peak_device_mb()) if run is not None else (None, None)
+    wall, cpu = time.perf_counter(), time.process_time()
+    try:
+        yield
+    finally:
+        wall, cpu = time.perf_counter() - wall, time.process_time() - cpu
+        counters.add(name, wall, cpu)
+        if run is not None:
+            run.add(name, wall, cpu, peaks)
+
+
+def timed(name: str):
+    """Decorator form of `stage`."""
+
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            with stage(name):
+                return fn(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def _max(a, b):
+    if a is None:
+        return b
+    if b is None:
+        return a
+    return max(a, b)
@@ -0,0 +1,127 @@
+from __future__ import annotations
+
+import importlib.util
+import os
+import threading
+
+import numpy as np
+import torch
+
+from dddetailer.detector import _Network, _test_pipeline, detect_with
+
+# the exported network must match the PyTorch one this closely on the export self-check
+RTOL = 1e-3
+ATOL = 1e-4
+
+
+def available() -> bool:
+    return importlib.util.find_spec("onnxruntime") is not None
+
+
+class OnnxSessions:
+    """ONNX Runtime CPU sessions for single-stage detection checkpoints, exported on first use.
+
+    The export is written next to the checkpoint as `<name>.onnx` and redone
+    when the checkpoint is newer. Before it is used, an export must
+    reproduce the PyTorch outputs on a random input; checkpoints whose export
+    fails that check are not tried again until they change.
+    """
+
+    def __init__(self):
+        self._sessions = {}
+        self._failed = set()
+        self._lock = threading.Lock()
+
+    def get(self, model, checkpoint: str):
+        checkpoint = os.path.abspath(checkpoint)
+        key = (checkpoint, os.path.getmtime(checkpoint))
+        with self._lock:
+            if key in self._failed:
+                return None
+            session = self._sessions.get(key)
+            if session is None:
+                session = self._load(model, checkpoint)
+                if session is None:
+                    self._failed.add(key)
+                    return None
+                self._sessions = {k: v for k, v in self._sessions.items() if k[0] != checkpoint}
+                self._sessions[key] = session
+            return session
+
+    def clear(self):
+        with self._lock:
+            self._sessions.clear()
+            self._failed.clear()
+
+    def _load(self, model, checkpoint: str):
+        import onnxruntime
+
+        path = os.path.splitext(checkpoint)[0] + ".onnx"
+        try:
+            if not os.path.exists(path) or os.path.getmtime(path) < os.path.getmtime(checkpoint):
+                export(model, path)
+            session = onnxruntime.InferenceSession(path, providers=["CPUExecutionProvider"])
+            check(model, session)
+        except Exception as e:
+            print(f"[-] dddetailer: ONNX export of {os.path.basename(checkpoint)} is not usable, using mmdet. ({e})")
+            if os.path.exists(path):
+                os.remove(path)
+            return None
+        return session
+
+
+def _sample_inputs(model):
+    from mmengine.dataset import pseudo_collate
+
+    pipeline = _test_pipeline(model)
+    data = pseudo_collate([pipeline({"img": np.zeros((512, 512, 3), dtype=np.uint8), "img_id": 0})])
+    inputs = model.data_preprocessor(data, False)["inputs"]
+    return inputs.float().uniform_(0, 1)
+
+
+def export(model, path: str):
+    network = _Network(model).eval()
+    inputs = _sample_inputs(model)
+    with torch.no_grad():
+        count = len(network(inputs))
+    names = [f"output{i}" for i in range(count)]
+    dynamic_axes = {"inputs": {0: "batch", 2: "height", 3: "width"}}
+    dynamic_axes.update({name: {0: "batch", 2: f"{name}_height", 3: f"{name}_width"} for name in names})
+
+    tmp = f"{path}.{os.getpid()}.tmp"
+    try:
+        with torch.no_grad():
+            torch.onnx.export(
+                network,
+                inputs,
+                tmp,
+                input_names=["inputs"],
+                output_names=names,
+                dynamic_axes=dynamic_axes,
+                opset_version=13,
+            )
+        os.replace(tmp, path)
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+
+
+def check(model, session):
+    inputs = _sample_inputs(model)
+    with torch.no_grad():
+        expected = [t.numpy() for t in _Network(model).eval()(inputs)]
+    actual = session.run(None, {"inputs": inputs.numpy()})
+    if len(actual) != len(expected):
+        raise RuntimeError(f"{len(actual)} outputs instead of {len(expected)}")
+    for i, (a, e) in enumerate(zip(actual, expected)):
+        if a.shape != e.shape or not np.allclose(a, e, rtol=RTOL, atol=ATOL):
+            raise RuntimeError(f"output {i} differs from PyTorch by up to {np.abs(a - e).max():.3g}")
+
+
+def detect(model, session, images: list, batch_size: int = 1) -> list:
+    """Same as `dddetailer.detector.detect`, with the network run by ONNX Runtime."""
+
+    def network(inputs):
+        return [torch.from_numpy(m) for m in session.run(None, {"inputs": inputs.float().numpy()})]
+
+    return detect_with(model, network, images, batch_size)
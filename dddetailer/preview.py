@@ -0,0 +1,57 @@
+from __future__ import annotations
+
+import cv2
+import numpy as np
+from PIL import Image
+
+from dddetailer.mask import Mask, _intersect_box
+
+ALPHA = 0.2
+
+
+def render_preview(image: Image.Image, labels, scores, masks: list[Mask], max_side: int = 0) -> Image.Image:
+    """Draw every mask in a random colour over `image`, with its label and score at its centroid.
+
+    Pixels covered by several masks take the colour of the last one. All
+    masks are painted into one label map covering only their union, which
+    is then blended in a single pass. With `max_side` the preview is drawn
+    on a copy of the image scaled down to at most that many pixels a side.
+    """
+    if len(masks) == 0:
+        return image
+
+    width, height = image.size
+    scale = min(max_side / max(width, height), 1.0) if max_side > 0 else 1.0
+    size = (max(round(width * scale), 1), max(round(height * scale), 1))
+    array = np.array(image.convert("RGB") if scale == 1.0 else image.convert("RGB").resize(size, Image.BILINEAR))
+    masks = [mask.resize(size) for mask in masks]
+    colors = np.random.randint(100, 256, (len(masks), 3), dtype=np.uint8)
+
+    boxes = np.array([mask.box for mask in masks])
+    roi = _intersect_box((*boxes[:, :2].min(axis=0), *boxes[:, 2:].max(axis=0)), (0, 0, *size))
+    x0, y0, x1, y1 = roi
+    label_map = np.zeros((y1 - y0, x1 - x0), dtype=np.uint16)
+    centroids = []
+    for i, mask in enumerate(masks):
+        mx0, my0, mx1, my1 = mask.box
+        region = label_map[my0 - y0 : my1 - y0, mx0 - x0 : mx1 - x0]
+        if mask.bitmap is None:
+            region[...] = i + 1
+            centroids.append(((mx0 + mx1 - 1) / 2, (my0 + my1 - 1) / 2))
+        else:
+            region[mask.bitmap] = i + 1
+            m = cv2.moments(mask.bitmap.view(np.uint8), binaryImage=True)
+            centroids.append((mx0 + m["m10"] / m["m00"], my0 + m["m01"] / m["m00"]) if m["m00"] else (mx0, my0))
+
+    covered = label_map > 0
+    view = array[y0:y1, x0:x1]
+    blended = view[covered] * ALPHA + colors[label_map[covered] - 1] * (1 - ALPHA)
+    view[covered] = np.rint(blended).astype(np.uint8)
+
+    for i, (cx, cy) in enumerate(centroids):
+        # the text is drawn in a darker shade of the same colour
+        text_color = tuple(int(c) for c in colors[i] - 100)
+        text = labels[i] + ":" + str(scores[i])[:4]
+        cv2.putText(array, text, (int(cx) - 30, int(cy)), cv2.FONT_HERSHEY_DUPLEX, 0.4, text_color, 1, cv2.LINE_AA)
+
+    return Image.fromarray(array)
@@ -0,0 +1,156 @@
+from __future__ import annotations
+
+import json
+import os
+import threading
+from dataclasses import asdict, dataclass
+from typing import Callable
+
+# bump when ModelInfo changes, so older indexes are rebuilt instead of misread
+INDEX_VERSION = 3
+
+
+@dataclass
+class ModelInfo:
+    path: str
+    size: int
+    mtime: float
+    short_hash: str  # the webui's model_hash, 8 hex digits of a 64 KiB slice
+    kind: str | None
+    config: str
+
+    @property
+    def name(self) -> str:
+        return os.path.splitext(os.path.basename(self.path))[0]
+
+
+class ModelRegistry:
+    """Index of the detection checkpoints under `root`.
+
+    The index is persisted to a JSON sidecar so that only files whose size or
+    mtime changed since the last scan are hashed again. A lookup miss only
+    rescans when the mtime of a scanned directory changed, i.e. when a file
+    was added, removed or renamed since the last scan.
+    """
+
+    def __init__(self, root: str, hash_fn: Callable[[str], str], index_name: str = ".dddetailer-index.json"):
+        self.root = os.path.abspath(root)
+        self.index_path = os.path.join(self.root, index_name)
+        self.hash_fn = hash_fn
+        self._by_title = {}
+        self._by_hash = {}
+        self._lock = threading.Lock()
+        self._scanned = False
+        self._dir_mtimes = {}
+
+    def titles(self) -> list[str]:
+        self._ensure_scanned()
+        return list(self._by_title)
+
+    def known_titles(self) -> list[str]:
+        """Titles from the last scan, or from the saved index before the first one. Never hashes."""
+        with self._lock:
+            if self._scanned:
+                return list(self._by_title)
+            return [self.title(info) for info in self._load_index().values() if os.path.exists(info.path)]
+
+    def get(self, title: str) -> ModelInfo | None:
+        self._ensure_scanned()
+        info = self._lookup(title)
+        if (info is None or not os.path.exists(info.path)) and self._changed():
+            self.refresh()
+            info = self._lookup(title)
+        return info
+
+    def refresh(self) -> list[str]:
+        with self._lock:
+            previous = self._load_index()
+            entries = {}
+            dir_mtimes = {}
+            for path in self._walk(dir_mtimes):
+                st = os.stat(path)
+                old = previous.get(path)
+                if old is not None and old.size == st.st_size and old.mtime == st.st_mtime:
+                    info = old
+                else:
+                    info = ModelInfo(
+                        path=path,
+                        size=st.st_size,
+                        mtime=st.st_mtime,
+                        short_hash=self.hash_fn(path),
+                        kind=self._kind(path),
+                        config=os.path.splitext(path)[0] + ".py",
+                    )
+                entries[path] = info
+
+            self._by_title = {self.title(info): info for info in entries.values()}
+            self._by_hash = {info.short_hash: info for info in entries.values()}
+            self._scanned = True
+            if entries != previous:
+                self._save_index(entries)
+                # the index lives in the root, so saving it changed the root's mtime
+                if self.root in dir_mtimes:
+                    dir_mtimes[self.root] = os.stat(self.root).st_mtime
+            self._dir_mtimes = dir_mtimes
+            return list(self._by_title)
+
+    def title(self, info: ModelInfo) -> str:
+        name = os.path.relpath(info.path, self.root)
+        return f"{name} [{info.short_hash}]"
+
+    def _lookup(self, title: str) -> ModelInfo | None:
+        info = self._by_title.get(title)
+        if info is None and "[" in title:
+            info = self._by_hash.get(title.split("[")[-1].split("]")[0])
+        return info
+
+    def _ensure_scanned(self):
+        if not self._scanned:
+            self.refresh()
+
+    def _changed(self) -> bool:
+        for path, mtime in self._dir_mtimes.items():
+            try:
+                if os.stat(path).st_mtime != mtime:
+                    return True
+            except OSError:
+                return True
+        # an unreadable or missing root is scanned again every time
+        return not self._dir_mtimes
+
+    def _walk(self, dir_mtimes: dict):
+        for dirpath, dirnames, filenames in os.walk(self.root, followlinks=True):
+            dir_mtimes[dirpath] = os.stat(dirpath).st_mtime
+            dirnames.sort()
+            for filename in sorted(filenames):
+                if filename.endswith(".pth"):
+                    yield os.path.join(dirpath, filename)
+
+    def _kind(self, path: str) -> str | None:
+        relpath = os.path.relpath(path, self.root)
+        if "bbox" in relpath:
+            return "bbox"
+        if "segm" in relpath:
+            return "segm"
+        return None
+
+    def _load_index(self) -> dict[str, ModelInfo]:
+        try:
+            with open(self.index_path, encoding="utf-8") as file:
+                data = json.load(file)
+            if data.get("version") != INDEX_VERSION:
+                return {}
+            return {item["path"]: ModelInfo(**item) for item in data["models"]}
+        except (OSError, ValueError, KeyError, TypeError):
+            return {}
+
+    def _save_index(self, entries: dict[str, ModelInfo]):
+        data = {"version": INDEX_VERSION, "models": [asdict(info) for info in entries.values()]}
+        tmp_path = f"{self.index_path}.{os.getpid()}.tmp"
+        try:
+            with open(tmp_path, "w", encoding="utf-8") as file:
+                json.dump(data, file, indent=2)
+            os.replace(tmp_path, self.index_path)
+        except OSError:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
@@ -0,0 +1,147 @@
+from __future__ import annotations
+
+import math
+from typing import Callable
+
+import numpy as np
+
+from dddetailer.detector import Detections
+from dddetailer.mask import Mask, _intersect_box
+
+# instances from different tiles that share more than this much of the smaller one are duplicates
+MERGE_THRESHOLD = 0.5
+
+
+def tile_boxes(size, tile: int, overlap: int) -> list:
+    """Cover a `size` (width, height) canvas with `tile` x `tile` boxes overlapping by at least `overlap`.
+
+    The last row and column are aligned with the canvas edge, and a side
+    shorter than `tile` gets a single, shorter tile.
+    """
+
+    def starts(length):
+        if length <= tile:
+            return [0]
+        step = max(tile - overlap, 1)
+        return [min(i * step, length - tile) for i in range(math.ceil((length - tile) / step) + 1)]
+
+    width, height = size
+    return [(x, y, min(x + tile, width), min(y + tile, height)) for y in starts(height) for x in starts(width)]
+
+
+def detect_tiled(
+    run: Callable,
+    array: np.ndarray,
+    tile: int,
+    overlap: int,
+    batch_size: int = 1,
+    score_thr: float = 0.0,
+    max_per_img: int = 0,
+) -> Detections:
+    """Detect on overlapping tiles of `array` and merge the results across tile seams.
+
+    `run` maps a list of tile arrays to their `pred_instances`. Tiles are
+    passed `batch_size` at a time and their results are made crop-local right
+    away, so memory does not grow with the image size. `max_per_img` applies
+    to every tile and then to the merged result.
+    """
+    size = (array.shape[1], array.shape[0])
+    boxes = tile_boxes(size, tile, overlap)
+    batch_size = max(int(batch_size), 1)
+    parts = []
+    for start in range(0, len(boxes), batch_size):
+        chunk = boxes[start : start + batch_size]
+        tiles = [np.ascontiguousarray(array[y0:y1, x0:x1]) for x0, y0, x1, y1 in chunk]
+        for box, instances in zip(chunk, run(tiles)):
+            parts.append(_place(Detections.from_instances(instances, score_thr, max_per_img), box, size))
+    return merge_detections(parts).limit(score_thr, max_per_img)
+
+
+def merge_detections(parts: list) -> Detections:
+    """Concatenate per-tile detections, dropping cross-tile duplicates.
+
+    Instances are visited by decreasing score. One is dropped when an already
+    kept instance of the same label from another tile covers more than
+    `MERGE_THRESHOLD` of the smaller of the two, measured on the masks when
+    there are masks and on the boxes otherwise. Objects cut by a seam are
+    thus kept from the tile that saw them best.
+
+    Every pair is first tested on its boxes in one numpy pass. Box pairs are
+    decided there, and mask pixels are only intersected for the few mask
+    pairs whose box overlap alone could reach the threshold.
+    """
+    tiles = np.concatenate([np.full(len(part), i) for i, part in enumerate(parts)])
+    labels = np.concatenate([part.labels for part in parts])
+    bboxes = np.concatenate([np.asarray(part.bboxes, dtype=np.float64).reshape(-1, 4) for part in parts])
+    scores = np.concatenate([part.scores for part in parts])
+    masks = [mask for part in parts for mask in part.masks]
+
+    candidates = (labels[:, None] == labels[None, :]) & (tiles[:, None] != tiles[None, :])
+    has_mask = np.array([mask is not None for mask in masks], dtype=bool)
+    both = has_mask[:, None] & has_mask[None, :]
+    # box pairs: the box overlap is the exact test
+    box_areas = (bboxes[:, 2] - bboxes[:, 0]) * (bboxes[:, 3] - bboxes[:, 1])
+    duplicates = candidates & ~both & _covers(_intersections(bboxes), box_areas)
+    # mask pairs: pixels shared by two masks lie inside both boxes, so an overlap
+    # of the mask boxes below the threshold rules the pair out
+    mask_boxes = np.array([mask.box if mask is not None else (0, 0, 0, 0) for mask in masks], dtype=np.int64)
+    mask_areas = np.array([mask.area if mask is not None else 0 for mask in masks], dtype=np.int64)
+    maybe = candidates & both & _covers(_intersections(mask_boxes.reshape(-1, 4)), mask_areas)
+
+    kept = np.zeros(len(scores), dtype=bool)
+    for i in np.argsort(-scores, kind="stable"):
+        if (duplicates[i] & kept).any():
+            continue
+        if any(_mask_overlap(masks[i], masks[k]) for k in np.flatnonzero(maybe[i] & kept)):
+            continue
+        kept[i] = True
+    kept = np.flatnonzero(kept)
+    return Detections(
+        labels=labels[kept],
+        bboxes=bboxes[kept].astype(np.float32),
+        scores=scores[kept],
+        masks=[masks[k] for k in kept],
+        score_thr=parts[0].score_thr,
+        max_per_img=parts[0].max_per_img,
+    )
+
+
+def _place(detections: Detections, box, size) -> Detections:
+    # move detections from tile coordinates to canvas coordinates
+    x0, y0 = box[:2]
+    masks = []
+    for mask in detections.masks:
+        if mask is not None:
+            mx0, my0, mx1, my1 = mask.box
+            mask = Mask((mx0 + x0, my0 + y0, mx1 + x0, my1 + y0), size, mask.bitmap)
+        masks.append(mask)
+    return Detections(
+        labels=detections.labels,
+        bboxes=np.asarray(detections.bboxes).reshape(-1, 4) + np.array([x0, y0, x0, y0], dtype=np.float32),
+        scores=detections.scores,
+        masks=masks,
+        score_thr=detections.score_thr,
+        max_per_img=detections.max_per_img,
+    )
+
+
+def _intersections(boxes: np.ndarray) -> np.ndarray:
+    # pairwise intersection areas of (x0, y0, x1, y1) boxes
+    width = np.minimum(boxes[:, None, 2], boxes[None, :, 2]) - np.maximum(boxes[:, None, 0], boxes[None, :, 0])
+    height = np.minimum(boxes[:, None, 3], boxes[None, :, 3]) - np.maximum(boxes[:, None, 1], boxes[None, :, 1])
+    return np.clip(width, 0, None) * np.clip(height, 0, None)
+
+
+def _covers(intersections: np.ndarray, areas: np.ndarray) -> np.ndarray:
+    # whether each pair shares more than MERGE_THRESHOLD of the smaller area
+    smaller = np.minimum(areas[:, None], areas[None, :])
+    return (smaller > 0) & (intersections > MERGE_THRESHOLD * smaller)
+
+
+def _mask_overlap(mask1: Mask, mask2: Mask) -> bool:
+    box = _intersect_box(mask1.box, mask2.box)
+    if box[0] == box[2] or box[1] == box[3]:
+        return False
+    inter = np.count_nonzero(mask1.crop(box) & mask2.crop(box))
+    smaller = min(mask1.area, mask2.area)
+    return smaller > 0 and inter / smaller > MERGE_THRESHOLD
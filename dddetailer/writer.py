@@ -0,0 +1,87 @@
+from __future__ import annotations
+
+import atexit
+import queue
+import threading
+import traceback
+from typing import Callable
+
+
+class ImageWriter:
+    """Run image saves on background threads, off the generation path.
+
+    Every worker owns a bounded queue, so images are never all held in
+    memory. When a worker's queue is full (the disk is not keeping up), the
+    save runs on the submitting thread instead of waiting for a free slot.
+    Saves that share a `key` (the output directory) always go to the same
+    worker, and a save is never run concurrently with another one of its
+    worker, which keeps the webui's sequential file numbering free of races.
+    Queued saves run in submission order. With zero threads `submit` saves
+    inline.
+    """
+
+    def __init__(self, threads: int = 1, queue_size: int = 4):
+        self.threads = threads
+        self.queue_size = queue_size
+        self._queues = []
+        self._lock = threading.Lock()
+        atexit.register(self.flush)
+
+    def submit(self, key: str, fn: Callable, *args, **kwargs):
+        if self.threads <= 0:
+            fn(*args, **kwargs)
+            return
+        workers = self._start()
+        q, lock = workers[hash(key) % len(workers)]
+        try:
+            q.put_nowait((fn, args, kwargs))
+        except queue.Full:
+            with lock:
+                _run(fn, args, kwargs)
+
+    def flush(self):
+        """Block until every save submitted so far has been written."""
+        for q, _ in list(self._queues):
+            q.join()
+
+    def resize(self, threads: int):
+        threads = max(int(threads), 0)
+        with self._lock:
+            if threads == self.threads:
+                return
+            self.threads = threads
+            workers, self._queues = self._queues, []
+        for q, _ in workers:
+            q.put(None)
+            q.join()
+
+    def _start(self) -> list:
+        with self._lock:
+            if not self._queues:
+                for i in range(self.threads):
+                    q = queue.Queue(maxsize=self.queue_size)
+                    lock = threading.Lock()
+                    name = f"dddetailer-writer-{i}"
+                    threading.Thread(target=_work, args=(q, lock), name=name, daemon=True).start()
+                    self._queues.append((q, lock))
+            return self._queues
+
+
+def _work(q: queue.Queue, lock: threading.Lock):
+    while True:
+        item = q.get()
+        try:
+            if item is None:
+                return
+            with lock:
+                _run(*item)
+        finally:
+            q.task_done()
+
+
+def _run(fn: Callable, args, kwargs):
+    try:
+        fn(*args, **kwargs)
+    except Exception:
+        print("[-] dddetailer: failed to save an image.")
+        traceback.print_exc()
@@ -1,21 +1,50 @@
+import hashlib
+import io
 import os
 import sys
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import ExitStack, contextmanager
 from copy import copy
+from importlib.metadata import PackageNotFoundError, version
 from pathlib import Path
 from textwrap import dedent
+from typing import List, Literal
 
 import cv2
 import gradio as gr
 import numpy as np
+import torch
 from basicsr.utils.download_util import load_file_from_url
+from gradio.context import Context
 from packaging.version import parse
-from PIL import Image
-
+from PIL import Image, ImageFilter, PngImagePlugin
+from pydantic import BaseModel, Field
+
+from dddetailer import compiled, metrics, onnx_backend
+from dddetailer.batch import Throughput, collect_inputs, pending, prefetch, write_atomic
+from dddetailer.cache import DetectionCache
+from dddetailer.detector import Detections, DetectorCache, detect, input_size, limits, single_stage
+from dddetailer.mask import (
+    Mask,
+    bitwise_masks,
+    combine_masks,
+    create_segmasks,
+    drop_empty_masks,
+    group_masks,
+    select_results,
+    transform_masks,
+    update_result_masks,
+)
+from dddetailer.preview import render_preview
+from dddetailer.registry import ModelRegistry
+from dddetailer.tiling import detect_tiled
+from dddetailer.writer import ImageWriter
 from launch import run
 from modules import (
     devices,
     images,
-    modelloader,
+    masking,
     processing,
     script_callbacks,
     scripts,
@@ -33,6 +62,20 @@ from modules.shared import cmd_opts, opts, state
 DETECTION_DETAILER = "Detection Detailer"
 dd_models_path = os.path.join(models_path, "mmdet")
 python = sys.executable
+detectors = DetectorCache()
+registry = ModelRegistry(dd_models_path, model_hash)
+onnx_sessions = onnx_backend.OnnxSessions()
+cache_path = os.path.join(Path(__file__).resolve().parents[1], "cache")
+detection_cache = DetectionCache(os.path.join(cache_path, "detections"))
+compiled_networks = compiled.CompiledNetworks(os.path.join(cache_path, "compiled"))
+image_writer = ImageWriter()
+detect_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="dddetailer-detect-ab")
+throughput = None
+startup_lock = threading.Lock()
+startup_done = False
+warmed_up = threading.Event()
+# seconds a page load waits for the warm-up (which may download models) before listing models anyway
+WARMUP_TIMEOUT = 300
 
 
 def check_ddetailer() -> bool:
@@ -50,56 +93,16 @@ def check_ddetailer() -> bool:
 
 
 def check_install() -> bool:
+    # package metadata only, so the check does not import mmdet and everything it pulls in
     try:
-        import mmcv
-        import mmdet
-        from mmdet.evaluation import get_classes
-    except Exception:
-        return False
-
-    if not hasattr(mmcv, "__version__") or not hasattr(mmdet, "__version__"):
+        v1 = parse(version("mmcv")) >= parse("2.0.0")
+        v2 = parse(version("mmdet")) >= parse("3.0.0")
+    except PackageNotFoundError:
         return False
-
-    v1 = parse(mmcv.__version__) >= parse("2.0.0")
-    v2 = parse(mmdet.__version__) >= parse("3.0.0")
     return v1 and v2
 
 
-def list_models(model_path):
-    model_list = modelloader.load_models(model_path=model_path, ext_filter=[".pth"])
-
-    def modeltitle(path, shorthash):
-        abspath = os.path.abspath(path)
-
-        if abspath.startswith(model_path):
-            name = abspath.replace(model_path, "")
-        else:
-            name = os.path.basename(path)
-
-        if name.startswith(("\\", "/")):
-            name = name[1:]
-
-        shortname = os.path.splitext(name.replace("/", "_").replace("\\", "_"))[0]
-
-        return f"{name} [{shorthash}]", shortname
-
-    models = []
-    for filename in model_list:
-        h = model_hash(filename)
-        title, short_model_name = modeltitle(filename, h)
-        models.append(title)
-
-    return models
-
-
-def startup():
-    if not check_ddetailer():
-        message = """
-        [-] dddetailer: dddetailer doesn't work with the original ddetailer extension.
-                        dddetailer는 원본 ddetailer 확장이 있을 때 동작하지 않습니다.
-        """
-        raise RuntimeError(dedent(message))
-
+def install():
     if not check_install():
         run(f'"{python}" -m pip uninstall -y mmcv mmcv-full mmdet mmengine')
         run(f'"{python}" -m pip install openmim', desc="Installing openmim", errdesc="Couldn't install openmim")
@@ -109,7 +112,18 @@ def startup():
             errdesc="Couldn't install mmdet",
         )
 
-    if len(list_models(dd_models_path)) == 0:
+
+def startup():
+    global startup_done
+    with startup_lock:
+        if startup_done:
+            return
+        _startup()
+        startup_done = True
+
+
+def _startup():
+    if len(registry.titles()) == 0:
         print("No detection models found, downloading...")
         bbox_path = os.path.join(dd_models_path, "bbox")
         segm_path = os.path.join(dd_models_path, "segm")
@@ -139,9 +153,38 @@ def startup():
             "https://raw.githubusercontent.com/Bing-su/dddetailer/master/config/coco_panoptic.py",
             segm_path,
         )
+        registry.refresh()
+
+    import mmdet.apis  # noqa: F401
+
+
+def warmup(*args, **kwargs):
+    # installs are done before the UI is built; only models and imports are warmed up here
+    def target():
+        try:
+            startup()
+        except Exception as e:
+            print(f"[-] dddetailer: warm-up failed, retrying on first use: {e}", file=sys.stderr)
+        finally:
+            warmed_up.set()
+
+    threading.Thread(target=target, name="dddetailer-warmup", daemon=True).start()
+
 
+def model_choices():
+    # the dropdowns are built from the last scan; a fresh install fills them once the warm-up is done
+    warmed_up.wait(WARMUP_TIMEOUT)
+    return ["None", *registry.titles()]
 
-startup()
+
+if not check_ddetailer():
+    message = """
+    [-] dddetailer: dddetailer doesn't work with the original ddetailer extension.
+                    dddetailer는 원본 ddetailer 확장이 있을 때 동작하지 않습니다.
+    """
+    raise RuntimeError(dedent(message))
+
+install()
 
 
 def gr_show(visible=True):
@@ -208,8 +251,11 @@ class DetectionDetailerScript(scripts.Script):
     def ui(self, is_img2img):
         import modules.ui
 
-        model_list = list_models(dd_models_path)
-        model_list.insert(0, "None")
+        model_list = ["None", *registry.known_titles()]
+
+        def refreshed_models():
+            return {"choices": ["None", *registry.titles()]}
+
         if is_img2img:
             info = gr.HTML(
                 '<p style="margin-bottom:0.75em">Recommended settings: Use from inpaint tab, inpaint at full res ON, denoise < 0.5</p>'
@@ -245,6 +291,12 @@ class DetectionDetailerScript(scripts.Script):
                     visible=True,
                     type="value",
                 )
+                modules.ui.create_refresh_button(
+                    dd_model_a,
+                    registry.refresh,
+                    refreshed_models,
+                    f"{'i2i' if is_img2img else 't2i'}_dd_refresh_model_a",
+                )
 
             with gr.Row():
                 dd_conf_a = gr.Slider(
@@ -306,6 +358,12 @@ class DetectionDetailerScript(scripts.Script):
                     visible=True,
                     type="value",
                 )
+                modules.ui.create_refresh_button(
+                    dd_model_b,
+                    registry.refresh,
+                    refreshed_models,
+                    f"{'i2i' if is_img2img else 't2i'}_dd_refresh_model_b",
+                )
 
             with gr.Row():
                 dd_conf_b = gr.Slider(
@@ -387,6 +445,13 @@ class DetectionDetailerScript(scripts.Script):
                     visible=True,
                 )
 
+        def populated_models():
+            choices = {"choices": model_choices(), "__type__": "update"}
+            return choices, choices
+
+        if Context.root_block is not None:
+            Context.root_block.load(populated_models, inputs=[], outputs=[dd_model_a, dd_model_b])
+
         dd_model_a.change(
             lambda modelname: {
                 dd_model_b: gr_show(modelname != "None"),
@@ -472,7 +537,12 @@ class DetectionDetailerScript(scripts.Script):
             ret += [dd_prompt, dd_neg_prompt]
         return ret
 
-    def run(
+    def run(self, p, *args, **kwargs):
+        # the run's timings are per request: concurrent API calls and batch jobs each get their own
+        with metrics.running(metrics.Run()):
+            return self._run(p, *args, **kwargs)
+
+    def _run(
         self,
         p,
         info,
@@ -497,6 +567,9 @@ class DetectionDetailerScript(scripts.Script):
         dd_prompt=None,
         dd_neg_prompt=None,
     ):
+        startup()
+        run_metrics = metrics.current.get()
+        metrics.counters.add_run()
         processing.fix_seed(p)
         seed = p.seed
         subseed = p.subseed
@@ -589,183 +662,207 @@ class DetectionDetailerScript(scripts.Script):
         output_images = []
 
         state.job_count = ddetail_count
-        for n in range(ddetail_count):
-            devices.torch_gc()
-            start_seed = seed + n
-
-            all_prompts.append(p_txt.prompt)
-            all_negative_prompts.append(p_txt.negative_prompt)
-            all_seeds.append(start_seed)
-            all_subseeds.append(subseed + n)
-
-            if is_txt2img:
-                print(f"Processing initial image for output generation {n + 1}.")
-                p_txt.seed = start_seed
+        image_writer.resize(opts.dd_save_threads)
+        model_a = (dd_model_a, dd_conf_a, dd_dilation_factor_a, dd_offset_x_a, dd_offset_y_a)
+        model_b = (dd_model_b, dd_conf_b, dd_dilation_factor_b, dd_offset_x_b, dd_offset_y_b)
+        use_b_pre = dd_model_b != "None" and dd_preprocess_b
+        use_bitwise = dd_model_b != "None" and dd_bitwise_op != "None"
+
+        def generate(n):
+            print(f"Processing initial image for output generation {n + 1}.")
+            p_txt.seed = seed + n
+            with metrics.stage("txt2img"):
                 processed = processing.process_images(p_txt)
-                init_image = processed.images[0]
-                info = processed.info
-                if not dd_prompt:
-                    p.prompt = processed.all_prompts[0]
-                if not dd_neg_prompt:
-                    p.negative_prompt = processed.all_negative_prompts[0]
-                all_prompts[n] = processed.all_prompts[0]
-                all_negative_prompts[n] = processed.all_negative_prompts[0]
-            else:
-                init_image = orig_image
-                p.prompt = p_txt.prompt
-                p.negative_prompt = p_txt.negative_prompt
-            p.cfg_scale = dd_cfg_scale
-
-            if opts.enable_pnginfo:
-                init_image.info["parameters"] = info
-
-            infotexts.append(info)
-            output_images.append(init_image)
-
-            masks_a = []
-            masks_b_pre = []
-
-            # Optional secondary pre-processing run
-            if dd_model_b != "None" and dd_preprocess_b:
-                label_b_pre = "B"
-                results_b_pre = inference(init_image, dd_model_b, dd_conf_b / 100.0, label_b_pre)
-                masks_b_pre = create_segmasks(results_b_pre)
-                masks_b_pre = dilate_masks(masks_b_pre, dd_dilation_factor_b, 1)
-                masks_b_pre = offset_masks(masks_b_pre, dd_offset_x_b, dd_offset_y_b)
-                if len(masks_b_pre) > 0:
-                    results_b_pre = update_result_masks(results_b_pre, masks_b_pre)
-                    segmask_preview_b = create_segmask_preview(results_b_pre, init_image)
-                    shared.state.current_image = segmask_preview_b
-                    if opts.dd_save_previews:
-                        images.save_image(
-                            segmask_preview_b,
-                            opts.outdir_ddetailer_previews,
-                            "",
-                            start_seed,
-                            p.prompt,
-                            opts.samples_format,
-                            p=p,
-                        )
-                    gen_count = len(masks_b_pre)
-                    state.job_count += gen_count
-                    print(f"Processing {gen_count} model {label_b_pre} detections for output generation {n + 1}.")
-                    p.seed = start_seed
-                    p.init_images = [init_image]
-
-                    for i in range(gen_count):
-                        p.image_mask = masks_b_pre[i]
-                        if opts.dd_save_masks:
-                            images.save_image(
-                                masks_b_pre[i],
-                                opts.outdir_ddetailer_masks,
+            return processed.images[0], processed.info, processed.all_prompts[0], processed.all_negative_prompts[0]
+
+        def detect_base(images):
+            # detections that only depend on the base image: (model B pre-pass, model A, model B)
+            if use_b_pre:
+                return [(d, None, None) for d in detect_masks_concurrently(images, (*model_b, "B"))[0]]
+            if dd_model_a == "None":
+                return [(None, None, None)] * len(images)
+            return [(None, a, b) for a, b in detect_primary(images)]
+
+        def detect_primary(images):
+            # model A and B run concurrently on one shared copy of each image
+            if not use_bitwise:
+                return [(a, None) for a in detect_masks_concurrently(images, (*model_a, "A"))[0]]
+            detections_a, detections_b = detect_masks_concurrently(images, (*model_a, dd_bitwise_op), (*model_b, "B"))
+            return list(zip(detections_a, detections_b))
+
+        # Detect on the base images ahead of the inpainting when they are known up front:
+        # img2img always starts from the same image, txt2img either generates every image first
+        # to detect them in batches, or detects image n on a worker thread while image n+1 generates.
+        generated = []
+        base_detections = []
+        pipeline = None
+        pipeline_depth = 0
+        if not is_txt2img:
+            base_detections = detect_base([orig_image]) * ddetail_count
+        elif opts.dd_detect_batch_size > 1 and ddetail_count > 1:
+            generated = [generate(n) for n in range(ddetail_count)]
+            base_detections = detect_base([g[0] for g in generated])
+        elif opts.dd_pipeline_depth > 0 and ddetail_count > 1:
+            pipeline = ThreadPoolExecutor(max_workers=1, thread_name_prefix="dddetailer-detect")
+            pipeline_depth = opts.dd_pipeline_depth
+
+        def fetch_base_detections(n):
+            if pipeline is not None:
+                # keep at most pipeline_depth images generated ahead of the one being inpainted
+                while len(generated) <= min(n + pipeline_depth, ddetail_count - 1) and not state.interrupted:
+                    generated.append(generate(len(generated)))
+                    detect_one = metrics.bind(lambda image: detect_base([image])[0])
+                    base_detections.append(pipeline.submit(detect_one, generated[-1][0]))
+            if n >= len(base_detections):
+                return None, None, None
+            detections = base_detections[n]
+            if isinstance(detections, Future):
+                detections = detections.result()
+            return tuple(
+                ([list(result) for result in d[0]], list(d[1])) if d is not None else None for d in detections
+            )
+
+        # each image's infotext shows the stages that finished since the previous image's
+        timings_mark = {}
+        try:
+            for n in range(ddetail_count):
+                devices.torch_gc()
+                start_seed = seed + n
+
+                all_prompts.append(p_txt.prompt)
+                all_negative_prompts.append(p_txt.negative_prompt)
+                all_seeds.append(start_seed)
+                all_subseeds.append(subseed + n)
+
+                detections_b_pre, detections_a, detections_b = fetch_base_detections(n)
+                if is_txt2img:
+                    init_image, info, prompt, negative_prompt = generated[n] if n < len(generated) else generate(n)
+                    if not dd_prompt:
+                        p.prompt = prompt
+                    if not dd_neg_prompt:
+                        p.negative_prompt = negative_prompt
+                    all_prompts[n] = prompt
+                    all_negative_prompts[n] = negative_prompt
+                else:
+                    init_image = orig_image
+                    p.prompt = p_txt.prompt
+                    p.negative_prompt = p_txt.negative_prompt
+                p.cfg_scale = dd_cfg_scale
+
+                if opts.enable_pnginfo:
+                    init_image.info["parameters"] = info
+
+                infotexts.append(info)
+                output_images.append(init_image)
+
+                masks_a = []
+                masks_b_pre = []
+
+                # Optional secondary pre-processing run
+                if use_b_pre:
+                    label_b_pre = "B"
+                    if detections_b_pre is None:
+                        detections_b_pre = detect_masks([init_image], *model_b, label_b_pre)[0]
+                    results_b_pre, masks_b_pre = detections_b_pre
+                    if len(masks_b_pre) > 0:
+                        results_b_pre = update_result_masks(results_b_pre, masks_b_pre)
+                        if previews_wanted():
+                            segmask_preview_b = create_segmask_preview(results_b_pre, init_image)
+                            shared.state.current_image = segmask_preview_b
+                        if opts.dd_save_previews:
+                            save_image(
+                                segmask_preview_b,
+                                opts.outdir_ddetailer_previews,
                                 "",
                                 start_seed,
                                 p.prompt,
                                 opts.samples_format,
                                 p=p,
                             )
-                        processed = processing.process_images(p)
-                        if not is_txt2img:
-                            p.prompt = processed.all_prompts[0]
-                            p.negative_prompt = processed.all_negative_prompts[0]
-                        p.seed = processed.seed + 1
-                        p.subseed = processed.subseed + 1
-                        p.init_images = [processed.images[0]]
+                        gen_count = len(masks_b_pre)
+                        print(f"Processing {gen_count} model {label_b_pre} detections for output generation {n + 1}.")
+                        processed = inpaint_detections(p, init_image, masks_b_pre, start_seed, is_txt2img)
 
-                    if gen_count > 0:
-                        output_images[n] = processed.images[0]
-                        init_image = processed.images[0]
-
-                else:
-                    print(f"No model B detections for output generation {n} with current settings.")
-
-            # Primary run
-            if dd_model_a != "None":
-                label_a = "A"
-                if dd_model_b != "None" and dd_bitwise_op != "None":
-                    label_a = dd_bitwise_op
-                results_a = inference(init_image, dd_model_a, dd_conf_a / 100.0, label_a)
-                masks_a = create_segmasks(results_a)
-                masks_a = dilate_masks(masks_a, dd_dilation_factor_a, 1)
-                masks_a = offset_masks(masks_a, dd_offset_x_a, dd_offset_y_a)
-                if dd_model_b != "None" and dd_bitwise_op != "None":
-                    label_b = "B"
-                    results_b = inference(init_image, dd_model_b, dd_conf_b / 100.0, label_b)
-                    masks_b = create_segmasks(results_b)
-                    masks_b = dilate_masks(masks_b, dd_dilation_factor_b, 1)
-                    masks_b = offset_masks(masks_b, dd_offset_x_b, dd_offset_y_b)
-                    if len(masks_b) > 0:
-                        combined_mask_b = combine_masks(masks_b)
-                        for i in reversed(range(len(masks_a))):
-                            if dd_bitwise_op == "A&B":
-                                masks_a[i] = bitwise_and_masks(masks_a[i], combined_mask_b)
-                            elif dd_bitwise_op == "A-B":
-                                masks_a[i] = subtract_masks(masks_a[i], combined_mask_b)
-                            if is_allblack(masks_a[i]):
-                                del masks_a[i]
-                                for result in results_a:
-                                    del result[i]
+                        if gen_count > 0:
+                            output_images[n] = processed.images[0]
+                            init_image = processed.images[0]
 
                     else:
-                        print("No model B detections to overlap with model A masks")
-                        results_a = []
-                        masks_a = []
-
-                if len(masks_a) > 0:
-                    results_a = update_result_masks(results_a, masks_a)
-                    segmask_preview_a = create_segmask_preview(results_a, init_image)
-                    shared.state.current_image = segmask_preview_a
-                    if opts.dd_save_previews:
-                        images.save_image(
-                            segmask_preview_a,
-                            opts.outdir_ddetailer_previews,
-                            "",
-                            start_seed,
-                            p.prompt,
-                            opts.samples_format,
-                            p=p,
-                        )
-                    gen_count = len(masks_a)
-                    state.job_count += gen_count
-                    print(f"Processing {gen_count} model {label_a} detections for output generation {n + 1}.")
-                    p.seed = start_seed
-                    p.init_images = [init_image]
-
-                    for i in range(gen_count):
-                        p.image_mask = masks_a[i]
-                        if opts.dd_save_masks:
-                            images.save_image(
-                                masks_a[i],
-                                opts.outdir_ddetailer_masks,
+                        print(f"No model B detections for output generation {n} with current settings.")
+
+                # Primary run
+                if dd_model_a != "None":
+                    label_a = "A"
+                    if use_bitwise:
+                        label_a = dd_bitwise_op
+                    if detections_a is None:
+                        detections_a, detections_b = detect_primary([init_image])[0]
+                    results_a, masks_a = detections_a
+                    if use_bitwise:
+                        results_b, masks_b = detections_b
+                        if len(masks_b) > 0:
+                            with metrics.stage("masks"):
+                                masks_a, keep = bitwise_masks(masks_a, masks_b, dd_bitwise_op)
+                                results_a = select_results(results_a, keep)
+                        else:
+                            print("No model B detections to overlap with model A masks")
+                            results_a = []
+                            masks_a = []
+
+                    if len(masks_a) > 0:
+                        results_a = update_result_masks(results_a, masks_a)
+                        if previews_wanted():
+                            segmask_preview_a = create_segmask_preview(results_a, init_image)
+                            shared.state.current_image = segmask_preview_a
+                        if opts.dd_save_previews:
+                            save_image(
+                                segmask_preview_a,
+                                opts.outdir_ddetailer_previews,
                                 "",
                                 start_seed,
                                 p.prompt,
                                 opts.samples_format,
                                 p=p,
                             )
-
-                        processed = processing.process_images(p)
+                        gen_count = len(masks_a)
+                        print(f"Processing {gen_count} model {label_a} detections for output generation {n + 1}.")
+                        processed = inpaint_detections(p, init_image, masks_a, start_seed, is_txt2img)
                         if not is_txt2img:
-                            p.prompt = processed.all_prompts[0]
-                            p.negative_prompt = processed.all_negative_prompts[0]
                             info = processed.info
                             all_prompts[n] = processed.all_prompts[0]
                             all_negative_prompts[n] = processed.all_negative_prompts[0]
-                        p.seed = processed.seed + 1
-                        p.subseed = processed.subseed + 1
-                        p.init_images = [processed.images[0]]
 
-                    if gen_count > 0:
-                        final_image = processed.images[0]
+                        if gen_count > 0:
+                            final_image = processed.images[0]
+                            info = timings_infotext(info, timings_mark)
+                            timings_mark = run_metrics.snapshot()
+
+                            if opts.enable_pnginfo:
+                                final_image.info["parameters"] = info
+                            output_images[n] = final_image
+                            infotexts[n] = info
+
+                            if opts.samples_save:
+                                save_image(
+                                    final_image,
+                                    p.outpath_samples,
+                                    "",
+                                    start_seed,
+                                    p.prompt,
+                                    opts.samples_format,
+                                    info=info,
+                                    p=p,
+                                )
 
-                        if opts.enable_pnginfo:
-                            final_image.info["parameters"] = info
-                        output_images[n] = final_image
-                        infotexts[n] = info
+                    else:
+                        print(f"No model {label_a} detections for output generation {n} with current settings.")
 
+                        info = timings_infotext(info, timings_mark)
+                        timings_mark = run_metrics.snapshot()
+                        infotexts[n] = info
                         if opts.samples_save:
-                            images.save_image(
-                                final_image,
+                            save_image(
+                                init_image,
                                 p.outpath_samples,
                                 "",
                                 start_seed,
@@ -775,22 +872,21 @@ class DetectionDetailerScript(scripts.Script):
                                 p=p,
                             )
 
-                else:
-                    print(f"No model {label_a} detections for output generation {n} with current settings.")
-
-                    if opts.samples_save:
-                        images.save_image(
-                            init_image,
-                            p.outpath_samples,
-                            "",
-                            start_seed,
-                            p.prompt,
-                            opts.samples_format,
-                            info=info,
-                            p=p,
-                        )
-
-            state.job = f"Generation {n + 1} out of {state.job_count}"
+                state.job = f"Generation {n + 1} out of {state.job_count}"
+        finally:
+            if pipeline is not None:
+                # after an error, detections still queued are dropped instead of run
+                for detections in base_detections:
+                    if isinstance(detections, Future):
+                        detections.cancel()
+                pipeline.shutdown(wait=True)
+            image_writer.flush()
+
+        if opts.dd_metrics_log:
+            try:
+                run_metrics.log(opts.dd_metrics_log, images=ddetail_count, model_a=dd_model_a, model_b=dd_model_b)
+            except OSError as e:
+                print(f"[-] dddetailer: cannot write timings to {opts.dd_metrics_log}: {e}")
 
         if dd_prompt or dd_neg_prompt:
             params_txt = os.path.join(data_path, "params.txt")
@@ -810,128 +906,347 @@ class DetectionDetailerScript(scripts.Script):
         )
 
 
-def modeldataset(model_shortname):
-    path = modelpath(model_shortname)
-    dataset = "coco" if "mmdet" in path and "segm" in path else "bbox"
-    return dataset
-
+BATCH_DEFAULTS = {
+    "prompt": "",
+    "negative_prompt": "",
+    "steps": 20,
+    "sampler_name": "Euler a",
+    "cfg_scale": 7,
+    # None: the size of each input image
+    "width": None,
+    "height": None,
+    "seed": -1,
+    "dd_model_a": "None",
+    "dd_conf_a": 30,
+    "dd_dilation_factor_a": 4,
+    "dd_offset_x_a": 0,
+    "dd_offset_y_a": 0,
+    "dd_preprocess_b": False,
+    "dd_bitwise_op": "None",
+    "dd_model_b": "None",
+    "dd_conf_b": 30,
+    "dd_dilation_factor_b": 4,
+    "dd_offset_x_b": 0,
+    "dd_offset_y_b": 0,
+    "dd_mask_blur": 4,
+    "dd_denoising_strength": 0.4,
+    "dd_inpaint_full_res": True,
+    "dd_inpaint_full_res_padding": 32,
+    "dd_cfg_scale": 7,
+}
+
+
+def detail_folder(source, output_dir, save_masks=True, prefetch_depth=4, **kwargs):
+    """Detail every image of a directory or glob `source` into `output_dir`, as PNGs of the same relative path.
+
+    `kwargs` override BATCH_DEFAULTS: the img2img settings and the script's
+    arguments by name; a width or height of None keeps each image's own.
+    Images whose output already exists are skipped, the
+    next images are read while one is being detailed, and masks go to
+    `output_dir`/masks when `save_masks` is set. Returns the Throughput.
+    """
+    global throughput
+    startup()
+    root, paths = collect_inputs(source)
+    jobs = pending(root, paths, output_dir)
+    settings = {**BATCH_DEFAULTS, **kwargs}
+    script_kwargs = {key: value for key, value in settings.items() if key.startswith("dd_")}
+    stats = Throughput()
+    stats.skipped = len(paths) - len(jobs)
+
+    def load(job):
+        with Image.open(job[0]) as image:
+            return image.convert("RGB")
+
+    # run() saves samples and masks through the options; the batch writes its own outputs instead
+    overrides = {
+        "samples_save": False,
+        "dd_save_masks": save_masks,
+        "outdir_ddetailer_masks": os.path.join(output_dir, "masks"),
+    }
+    saved = {key: opts.data[key] for key in overrides if key in opts.data}
+    opts.data.update(overrides)
+    throughput = stats
+    state.begin()
+    try:
+        for (path, output), image in prefetch(jobs, load, prefetch_depth):
+            if state.interrupted:
+                break
+            p = StableDiffusionProcessingImg2Img(
+                init_images=[image],
+                resize_mode=0,
+                denoising_strength=settings["dd_denoising_strength"],
+                mask=None,
+                mask_blur=settings["dd_mask_blur"],
+                inpainting_fill=1,
+                inpaint_full_res=settings["dd_inpaint_full_res"],
+                inpaint_full_res_padding=settings["dd_inpaint_full_res_padding"],
+                inpainting_mask_invert=0,
+                sd_model=shared.sd_model,
+                outpath_samples=output_dir,
+                outpath_grids=output_dir,
+                prompt=settings["prompt"],
+                negative_prompt=settings["negative_prompt"],
+                seed=settings["seed"],
+                sampler_name=settings["sampler_name"],
+                steps=settings["steps"],
+                cfg_scale=settings["cfg_scale"],
+                width=settings["width"] or image.width,
+                height=settings["height"] or image.height,
+            )
+            processed = DetectionDetailerScript().run(p, None, br=None, **script_kwargs)
+            pnginfo = PngImagePlugin.PngInfo()
+            pnginfo.add_text("parameters", processed.infotexts[0])
+            buffer = io.BytesIO()
+            processed.images[0].save(buffer, format="PNG", pnginfo=pnginfo)
+            write_atomic(output, buffer.getvalue())
+            stats.images += 1
+            print(f"[-] dddetailer: {path} -> {output}")
+    finally:
+        for key in overrides:
+            if key in saved:
+                opts.data[key] = saved[key]
+            else:
+                opts.data.pop(key, None)
+        throughput = None
+        state.end()
 
-def modelpath(model_shortname):
-    model_list = modelloader.load_models(model_path=dd_models_path, ext_filter=[".pth"])
-    model_h = model_shortname.split("[")[-1].split("]")[0]
-    for path in model_list:
-        if model_hash(path) == model_h:
-            return path
-    return None
-
-
-def update_result_masks(results, masks):
-    for i in range(len(masks)):
-        boolmask = np.array(masks[i], dtype=bool)
-        results[2][i] = boolmask
-    return results
+    print(f"[-] dddetailer: {stats.report()}")
+    return stats
 
 
-def create_segmask_preview(results, image):
-    labels = results[0]
-    bboxes = results[1]
-    segms = results[2]
-    scores = results[3]
-
-    cv2_image = np.array(image)
-    cv2_image = cv2_image[:, :, ::-1].copy()
-
-    for i in range(len(segms)):
-        color = np.full_like(cv2_image, np.random.randint(100, 256, (1, 3), dtype=np.uint8))
-        alpha = 0.2
-        color_image = cv2.addWeighted(cv2_image, alpha, color, 1 - alpha, 0)
-        cv2_mask = segms[i].astype(np.uint8) * 255
-        cv2_mask_bool = np.array(segms[i], dtype=bool)
-        centroid = np.mean(np.argwhere(cv2_mask_bool), axis=0)
-        centroid_x, centroid_y = int(centroid[1]), int(centroid[0])
-
-        cv2_mask_rgb = cv2.merge((cv2_mask, cv2_mask, cv2_mask))
-        cv2_image = np.where(cv2_mask_rgb == 255, color_image, cv2_image)
-        text_color = tuple([int(x) for x in (color[0][0] - 100)])
-        name = labels[i]
-        score = scores[i]
-        score = str(score)[:4]
-        text = name + ":" + score
-        cv2.putText(
-            cv2_image,
-            text,
-            (centroid_x - 30, centroid_y),
-            cv2.FONT_HERSHEY_DUPLEX,
-            0.4,
-            text_color,
-            1,
-            cv2.LINE_AA,
-        )
+def inpaint_detections(p, init_image, masks, start_seed, is_txt2img):
+    if opts.dd_batch_inpaint and p.inpaint_full_res and len(masks) > 1:
+        if throughput is not None:
+            throughput.detections += len(masks)
+        return inpaint_detections_batched(p, init_image, masks, start_seed, is_txt2img)
 
-    if len(segms) > 0:
-        preview_image = Image.fromarray(cv2.cvtColor(cv2_image, cv2.COLOR_BGR2RGB))
+    if opts.dd_group_detections:
+        padding = 2 * max(mask_blur_xy(p)) + (p.inpaint_full_res_padding if p.inpaint_full_res else 0)
+        groups = group_masks(masks, padding)
     else:
-        preview_image = image
-
-    return preview_image
+        groups = [[i] for i in range(len(masks))]
+
+    state.job_count += len(groups)
+    if throughput is not None:
+        throughput.detections += len(masks)
+    p.seed = start_seed
+    p.init_images = [init_image]
+
+    processed = None
+    for group in groups:
+        p.image_mask = combine_masks([masks[i] for i in group]).to_image()
+        if opts.dd_save_masks:
+            save_image(
+                p.image_mask,
+                opts.outdir_ddetailer_masks,
+                "",
+                start_seed,
+                p.prompt,
+                opts.samples_format,
+                p=p,
+            )
 
+        with metrics.stage("inpaint"):
+            processed = processing.process_images(p)
+        if not is_txt2img:
+            p.prompt = processed.all_prompts[0]
+            p.negative_prompt = processed.all_negative_prompts[0]
+        p.seed = processed.seed + 1
+        p.subseed = processed.subseed + 1
+        p.init_images = [processed.images[0]]
+
+    return processed
+
+
+def detect_masks(arrays, modelname, conf, dilation_factor, offset_x, offset_y, label):
+    detections = []
+    for array, results in zip(arrays, inference_batch(arrays, modelname, conf / 100.0, label)):
+        with metrics.stage("masks"):
+            masks = create_segmasks(results, (array.shape[1], array.shape[0]))
+            masks = transform_masks(masks, dilation_factor, offset_x, offset_y)
+            detections.append(drop_empty_masks(results, masks))
+    return detections
+
+
+def detect_masks_concurrently(images, *jobs):
+    # every job is the detect_masks arguments after the images; the images are converted once and shared
+    arrays = [np.array(image) for image in images]
+    futures = [detect_executor.submit(metrics.bind(in_own_stream), detect_masks, arrays, *job) for job in jobs[1:]]
+    detections = [in_own_stream(detect_masks, arrays, *jobs[0])]
+    detections.extend(future.result() for future in futures)
+    return detections
+
+
+def save_image(image, path, *args, p=None, **kwargs):
+    # p keeps changing while the save waits in the queue, so the writer gets a snapshot of it
+    save = metrics.bind(metrics.timed("save")(images.save_image))
+    image_writer.submit(path, save, image, path, *args, p=copy(p), **kwargs)
+
+
+class CropBatch(StableDiffusionProcessingImg2Img):
+    """An img2img batch whose items are full resolution inpaints of different masks of one image.
+
+    Every item is set up by the img2img init of its own single-image copy of
+    `p` (`items`), so mask blur, padding, cropping, inpainting fill and
+    inpainting-model conditioning are exactly those of inpainting the masks
+    one by one. Only their latents, latent masks and conditioning are
+    stacked, and the batch is sampled once. process_images leaves the results
+    as crops; `paste` puts each one back the way img2img would.
+    """
+
+    @classmethod
+    def of(cls, p, items):
+        batch = cls.__new__(cls)
+        batch.__dict__.update(p.__dict__)
+        batch.items = items
+        batch.batch_size = len(items)
+        batch.n_iter = 1
+        return batch
+
+    def init(self, all_prompts, all_seeds, all_subseeds):
+        for i, item in enumerate(self.items):
+            item.init(all_prompts[i : i + 1], all_seeds[i : i + 1], all_subseeds[i : i + 1])
+        self.sampler = self.items[0].sampler
+        self.init_latent = torch.cat([item.init_latent for item in self.items])
+        self.image_conditioning = torch.cat([item.image_conditioning for item in self.items])
+        self.mask = torch.stack([item.mask for item in self.items])
+        self.nmask = torch.stack([item.nmask for item in self.items])
+        corrections = [item.color_corrections for item in self.items]
+        self.color_corrections = None if None in corrections else [c for cs in corrections for c in cs]
+        # each item has its own paste location, so the overlays are applied by paste() instead
+        self.overlay_images = None
+        self.paste_to = None
+        self.mask_for_overlay = None
+
+    def paste(self, image, results):
+        for item, result in zip(self.items, results):
+            result = processing.apply_overlay(result, item.paste_to, 0, item.overlay_images)
+            x, y, w, h = item.paste_to
+            image.paste(result.crop((x, y, x + w, y + h)), (x, y))
+        return image
+
+
+def mask_blur_xy(p):
+    # webui blurs each axis on its own, and its p.mask_blur is None when the two differ
+    if hasattr(p, "mask_blur_x"):
+        return p.mask_blur_x, p.mask_blur_y
+    return p.mask_blur, p.mask_blur
+
+
+def blurred_mask(p, mask_image):
+    # the blur img2img's init applies to image_mask, so the crop region can be computed up front
+    if hasattr(p, "mask_blur_x"):
+        blur_x, blur_y = mask_blur_xy(p)
+        array = np.array(mask_image)
+        if blur_x > 0:
+            kernel = 2 * int(2.5 * blur_x + 0.5) + 1
+            array = cv2.GaussianBlur(array, (kernel, 1), blur_x)
+        if blur_y > 0:
+            kernel = 2 * int(2.5 * blur_y + 0.5) + 1
+            array = cv2.GaussianBlur(array, (1, kernel), blur_y)
+        return Image.fromarray(array)
+    if p.mask_blur > 0:
+        return mask_image.filter(ImageFilter.GaussianBlur(p.mask_blur))
+    return mask_image
+
+
+def inpaint_detections_batched(p, init_image, masks, start_seed, is_txt2img):
+    """Inpaint every detection at full resolution, with crops that do not overlap batched together.
+
+    Each crop gets its own mask, so the output matches inpainting the
+    detections one at a time (`inpaint_detections`) up to the sampler's
+    batch nondeterminism. Crops in one batch never overlap, and each batch
+    starts from the image the previous batches produced.
+    """
+    width, height = init_image.size
+    mask_images = []
+    regions = []
+    for mask in masks:
+        mask_image = blurred_mask(p, mask.to_image())
+        region = masking.get_crop_region(np.array(mask_image), p.inpaint_full_res_padding)
+        mask_images.append(mask_image)
+        regions.append(masking.expand_crop_region(region, p.width, p.height, width, height))
+
+    groups = group_masks([Mask(region, (width, height)) for region in regions])
+    batch_size = opts.dd_inpaint_batch_size
+    batches = [group[i : i + batch_size] for group in groups for i in range(0, len(group), batch_size)]
+    state.job_count += len(batches)
+
+    # the items' own init never sees the blur, so it is recorded here as img2img would
+    blur_x, blur_y = mask_blur_xy(p)
+    if blur_x == blur_y and blur_x > 0:
+        p.extra_generation_params["Mask blur"] = blur_x
+    image = init_image
+    processed = None
+    for batch in batches:
+        items = []
+        for i in batch:
+            item = copy(p)
+            item.init_images = [image]
+            item.image_mask = mask_images[i]
+            # already blurred above
+            item.mask_blur = 0
+            item.batch_size = 1
+            item.n_iter = 1
+            item.extra_generation_params = dict(p.extra_generation_params)
+            items.append(item)
+            if opts.dd_save_masks:
+                save_image(
+                    masks[i].to_image(),
+                    opts.outdir_ddetailer_masks,
+                    "",
+                    start_seed,
+                    p.prompt,
+                    opts.samples_format,
+                    p=p,
+                )
 
-def is_allblack(mask):
-    cv2_mask = np.array(mask)
-    return cv2.countNonZero(cv2_mask) == 0
+        p_batch = CropBatch.of(p, items)
+        # same seeds as inpainting the detections one by one in index order
+        p_batch.seed = [start_seed + i for i in batch]
+        p_batch.subseed = [p.subseed + i for i in batch]
+        with metrics.stage("inpaint"):
+            processed = processing.process_images(p_batch)
+        image = p_batch.paste(image.copy(), processed.images)
 
+        if not is_txt2img:
+            p.prompt = processed.all_prompts[0]
+            p.negative_prompt = processed.all_negative_prompts[0]
 
-def bitwise_and_masks(mask1, mask2):
-    cv2_mask1 = np.array(mask1)
-    cv2_mask2 = np.array(mask2)
-    cv2_mask = cv2.bitwise_and(cv2_mask1, cv2_mask2)
-    mask = Image.fromarray(cv2_mask)
-    return mask
+    p.seed = start_seed + len(masks)
+    p.subseed = p.subseed + len(masks)
+    p.init_images = [image]
+    processed.images = [image]
+    return processed
 
 
-def subtract_masks(mask1, mask2):
-    cv2_mask1 = np.array(mask1)
-    cv2_mask2 = np.array(mask2)
-    cv2_mask = cv2.subtract(cv2_mask1, cv2_mask2)
-    mask = Image.fromarray(cv2_mask)
-    return mask
+def modeldataset(model_shortname):
+    info = registry.get(model_shortname)
+    dataset = "coco" if info is not None and info.kind == "segm" else "bbox"
+    return dataset
 
 
-def dilate_masks(masks, dilation_factor, iter=1):
-    if dilation_factor == 0:
-        return masks
-    dilated_masks = []
-    kernel = np.ones((dilation_factor, dilation_factor), np.uint8)
-    for i in range(len(masks)):
-        cv2_mask = np.array(masks[i])
-        dilated_mask = cv2.dilate(cv2_mask, kernel, iter)
-        dilated_masks.append(Image.fromarray(dilated_mask))
-    return dilated_masks
+def modelpath(model_shortname):
+    info = registry.get(model_shortname)
+    return info.path if info is not None else None
 
 
-def offset_masks(masks, offset_x, offset_y):
-    if offset_x == 0 and offset_y == 0:
-        return masks
-    offset_masks = []
-    for i in range(len(masks)):
-        cv2_mask = np.array(masks[i])
-        offset_mask = cv2_mask.copy()
-        offset_mask = np.roll(offset_mask, -offset_y, axis=0)
-        offset_mask = np.roll(offset_mask, offset_x, axis=1)
+def create_segmask_preview(results, image):
+    with metrics.stage("preview"):
+        return render_preview(image, results[0], results[3], results[2], opts.dd_preview_max_side)
 
-        offset_masks.append(Image.fromarray(offset_mask))
-    return offset_masks
 
+def previews_wanted():
+    return opts.dd_save_previews or getattr(opts, "live_previews_enable", True)
 
-def combine_masks(masks):
-    initial_cv2_mask = np.array(masks[0])
-    combined_cv2_mask = initial_cv2_mask
-    for i in range(1, len(masks)):
-        cv2_mask = np.array(masks[i])
-        combined_cv2_mask = cv2.bitwise_or(combined_cv2_mask, cv2_mask)
 
-    combined_mask = Image.fromarray(combined_cv2_mask)
-    return combined_mask
+def timings_infotext(info, since):
+    # appended to the finished infotext, since extra_generation_params is rendered before the last inpaint ends
+    run_metrics = metrics.current.get()
+    if not opts.dd_metrics_infotext or run_metrics is None:
+        return info
+    return f'{info}, DDetailer timings: "{run_metrics.infotext(since)}"'
 
 
 def on_ui_settings():
@@ -959,21 +1274,196 @@ def on_ui_settings():
             section=("ddetailer", DETECTION_DETAILER),
         ),
     )
-
-
-def create_segmasks(results):
-    segms = results[2]
-    segmasks = []
-    for i in range(len(segms)):
-        cv2_mask = segms[i].astype(np.uint8) * 255
-        mask = Image.fromarray(cv2_mask)
-        segmasks.append(mask)
-
-    return segmasks
-
-
-from mmdet.apis import inference_detector, init_detector
-from mmdet.evaluation import get_classes
+    shared.opts.add_option(
+        "dd_group_detections",
+        shared.OptionInfo(
+            False,
+            "Inpaint detections that do not overlap in a single pass (works best with inpaint at full resolution off)",
+            section=("ddetailer", DETECTION_DETAILER),
+        ),
+    )
+    shared.opts.add_option(
+        "dd_batch_inpaint",
+        shared.OptionInfo(
+            False,
+            "Inpaint the full resolution crops of detections in img2img batches (overlapping crops are never batched)",
+            section=("ddetailer", DETECTION_DETAILER),
+        ),
+    )
+    shared.opts.add_option(
+        "dd_inpaint_batch_size",
+        shared.OptionInfo(
+            4,
+            "Crops per batch for batched inpainting (each crop takes the VRAM of one img2img batch item)",
+            gr.Slider,
+            {"minimum": 1, "maximum": 16, "step": 1},
+            section=("ddetailer", DETECTION_DETAILER),
+        ),
+    )
+    shared.opts.add_option(
+        "dd_detect_batch_size",
+        shared.OptionInfo(
+            1,
+            "Detection batch size (above 1, txt2img generates every base image before detecting on them)",
+            gr.Slider,
+            {"minimum": 1, "maximum": 16, "step": 1},
+            section=("ddetailer", DETECTION_DETAILER),
+        ),
+    )
+    shared.opts.add_option(
+        "dd_pipeline_depth",
+        shared.OptionInfo(
+            0,
+            "txt2img: number of images generated ahead while detection runs on a worker thread (0: off)",
+            gr.Slider,
+            {"minimum": 0, "maximum": 4, "step": 1},
+            section=("ddetailer", DETECTION_DETAILER),
+        ),
+    )
+    shared.opts.add_option(
+        "dd_max_detectors",
+        shared.OptionInfo(
+            2,
+            "Maximum number of detection models kept in memory (🔄 unloads them all)",
+            gr.Slider,
+            {"minimum": 1, "maximum": 8, "step": 1},
+            onchange=lambda: detectors.resize(opts.dd_max_detectors),
+            refresh=unload_detectors,
+            section=("ddetailer", DETECTION_DETAILER),
+        ),
+    )
+    shared.opts.add_option(
+        "dd_preview_max_side",
+        shared.OptionInfo(
+            0,
+            "Longest side of mask previews in pixels (0: full resolution)",
+            gr.Slider,
+            {"minimum": 0, "maximum": 4096, "step": 64},
+            section=("ddetailer", DETECTION_DETAILER),
+        ),
+    )
+    shared.opts.add_option(
+        "dd_save_threads",
+        shared.OptionInfo(
+            1,
+            "Background threads saving previews, masks and samples (0: save on the generation thread)",
+            gr.Slider,
+            {"minimum": 0, "maximum": 8, "step": 1},
+            section=("ddetailer", DETECTION_DETAILER),
+        ),
+    )
+    shared.opts.add_option(
+        "dd_max_detections",
+        shared.OptionInfo(
+            0,
+            "Maximum number of detections per image and model, best scores first (0: the model's own limit)",
+            gr.Slider,
+            {"minimum": 0, "maximum": 100, "step": 1},
+            section=("ddetailer", DETECTION_DETAILER),
+        ),
+    )
+    shared.opts.add_option(
+        "dd_detect_max_side_bbox",
+        shared.OptionInfo(
+            0,
+            "bbox models: detect on a copy downscaled to this longest side in pixels (0: full resolution)",
+            gr.Slider,
+            {"minimum": 0, "maximum": 4096, "step": 64},
+            section=("ddetailer", DETECTION_DETAILER),
+        ),
+    )
+    shared.opts.add_option(
+        "dd_detect_max_side_segm",
+        shared.OptionInfo(
+            0,
+            "segm models: detect on a copy downscaled to this longest side in pixels (0: full resolution)",
+            gr.Slider,
+            {"minimum": 0, "maximum": 4096, "step": 64},
+            section=("ddetailer", DETECTION_DETAILER),
+        ),
+    )
+    shared.opts.add_option(
+        "dd_tiled_detection",
+        shared.OptionInfo(
+            False,
+            "Detect on overlapping tiles and merge the results (finds small objects on large images)",
+            section=("ddetailer", DETECTION_DETAILER),
+        ),
+    )
+    shared.opts.add_option(
+        "dd_tile_size",
+        shared.OptionInfo(
+            0,
+            "Tile size in pixels for tiled detection (0: the model's input size)",
+            gr.Slider,
+            {"minimum": 0, "maximum": 2048, "step": 32},
+            section=("ddetailer", DETECTION_DETAILER),
+        ),
+    )
+    shared.opts.add_option(
+        "dd_tile_overlap",
+        shared.OptionInfo(
+            128,
+            "Overlap between neighbouring detection tiles in pixels",
+            gr.Slider,
+            {"minimum": 0, "maximum": 512, "step": 16},
+            section=("ddetailer", DETECTION_DETAILER),
+        ),
+    )
+    shared.opts.add_option(
+        "dd_tile_batch_size",
+        shared.OptionInfo(
+            4,
+            "Detection tiles per detector batch",
+            gr.Slider,
+            {"minimum": 1, "maximum": 16, "step": 1},
+            section=("ddetailer", DETECTION_DETAILER),
+        ),
+    )
+    shared.opts.add_option(
+        "dd_onnx_cpu",
+        shared.OptionInfo(
+            True,
+            "Run bbox models with ONNX Runtime when detecting on CPU (exported next to the model on first use)",
+            section=("ddetailer", DETECTION_DETAILER),
+        ),
+    )
+    shared.opts.add_option(
+        "dd_compiled_detector",
+        shared.OptionInfo(
+            False,
+            "Run bbox models as TorchScript traces of a few padded input sizes (traced once, cached on disk)",
+            section=("ddetailer", DETECTION_DETAILER),
+        ),
+    )
+    shared.opts.add_option(
+        "dd_detection_cache_size",
+        shared.OptionInfo(
+            0,
+            "Disk cache size for raw detection results in MB, for detailing the same images again; "
+            "shared by all webui processes (0: off, 🔄 clears it)",
+            gr.Slider,
+            {"minimum": 0, "maximum": 16384, "step": 64},
+            refresh=clear_detection_cache,
+            section=("ddetailer", DETECTION_DETAILER),
+        ),
+    )
+    shared.opts.add_option(
+        "dd_metrics_infotext",
+        shared.OptionInfo(
+            False,
+            "Add the time spent in each stage since the previous image to the infotext",
+            section=("ddetailer", DETECTION_DETAILER),
+        ),
+    )
+    shared.opts.add_option(
+        "dd_metrics_log",
+        shared.OptionInfo(
+            "",
+            "Append the time and memory peaks of every stage of each run to this JSON lines file (empty: off)",
+            section=("ddetailer", DETECTION_DETAILER),
+        ),
+    )
 
 
 def get_device():
@@ -985,73 +1475,276 @@ def get_device():
     return device
 
 
+def in_own_stream(fn, *args):
+    device = torch.device(get_device())
+    if device.type != "cuda":
+        return fn(*args)
+    stream = torch.cuda.Stream(device)
+    with torch.cuda.stream(stream):
+        result = fn(*args)
+    stream.synchronize()
+    return result
+
+
+@contextmanager
+def load_detector(model_checkpoint):
+    # the model stays on its device until the block ends, even if it is evicted meanwhile
+    model_config = os.path.splitext(model_checkpoint)[0] + ".py"
+    detectors.resize(opts.dd_max_detectors)
+    with ExitStack() as stack:
+        with metrics.stage("load"):
+            model = stack.enter_context(detectors.lease(model_config, model_checkpoint, get_device()))
+        yield model
+
+
+def clear_detection_cache():
+    count = detection_cache.clear()
+    print(f"[-] dddetailer: removed {count} cached detection(s).")
+
+
+def unload_detectors():
+    count = detectors.clear()
+    onnx_sessions.clear()
+    compiled_networks.clear()
+    devices.torch_gc()
+    print(f"[-] dddetailer: unloaded {count} detection model(s).")
+
+
 def inference(image, modelname, conf_thres, label):
-    path = modelpath(modelname)
-    if "mmdet" in path and "bbox" in path:
-        results = inference_mmdet_bbox(image, modelname, conf_thres, label)
-    elif "mmdet" in path and "segm" in path:
-        results = inference_mmdet_segm(image, modelname, conf_thres, label)
+    return inference_batch([np.array(image)], modelname, conf_thres, label)[0]
+
+
+def inference_batch(arrays, modelname, conf_thres, label):
+    startup()
+    info = registry.get(modelname)
+    if info is None:
+        raise ValueError(f"[-] dddetailer: model {modelname!r} not found in {dd_models_path}")
+    with metrics.stage("detect"):
+        if info.kind == "bbox":
+            results = inference_mmdet_bbox(arrays, modelname, conf_thres, label)
+        elif info.kind == "segm":
+            results = inference_mmdet_segm(arrays, modelname, conf_thres, label)
     return results
 
 
-def inference_mmdet_segm(image, modelname, conf_thres, label):
-    model_checkpoint = modelpath(modelname)
-    model_config = os.path.splitext(model_checkpoint)[0] + ".py"
-    model_device = get_device()
-    model = init_detector(model_config, model_checkpoint, device=model_device)
-    mmdet_results = inference_detector(model, np.array(image)).pred_instances
-    bboxes = mmdet_results.bboxes.cpu().numpy()
-    segms = mmdet_results.masks.cpu().numpy()
-    scores = mmdet_results.scores.cpu().numpy()
+def config_hash(info):
+    with open(info.config, "rb") as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+
+def detector_outputs(modelname, arrays, conf_thres):
+    info = registry.get(modelname)
+    max_per_img = opts.dd_max_detections
+    max_side = opts.dd_detect_max_side_bbox if info.kind == "bbox" else opts.dd_detect_max_side_segm
+    detection_cache.resize(opts.dd_detection_cache_size << 20)
+    tiling = (opts.dd_tile_size, opts.dd_tile_overlap) if opts.dd_tiled_detection else None
+    keys = [None] * len(arrays)
+    if detection_cache.enabled:
+        keys = [detection_cache.key(array, info.short_hash, config_hash(info), max_side, tiling) for array in arrays]
+
+    # cached entries are detected with the config's own limits only, so one entry serves every threshold and cap;
+    # entries written by older versions with tighter limits are detected again
+    outputs = [detection_cache.get(key) for key in keys]
+    missing = [i for i, output in enumerate(outputs) if output is None or not output.covers(conf_thres, max_per_img)]
+    if missing:
+        small = [downscale(arrays[i], max_side) for i in missing]
+        score_thr, cap = (0.0, 0) if detection_cache.enabled else (conf_thres, max_per_img)
+        with load_detector(info.path) as model, limits(model, score_thr, cap):
+            if tiling is not None:
+                # tiles default to the model's own input size, so the detector sees them at full detail
+                tile = opts.dd_tile_size or input_size(model) or 1024
+                batch_size = opts.dd_tile_batch_size
+
+                def run(tiles):
+                    return run_detector(model, info, tiles, batch_size)
+
+                detections = [
+                    detect_tiled(run, array, tile, opts.dd_tile_overlap, batch_size, score_thr, cap) for array in small
+                ]
+            else:
+                detections = [
+                    Detections.from_instances(instances, score_thr, cap)
+                    for instances in run_detector(model, info, small)
+                ]
+        for i, output in zip(missing, detections):
+            outputs[i] = output
+            detection_cache.put(keys[i], output)
+
+    outputs = [output.limit(conf_thres, max_per_img) for output in outputs]
+    # results are detected and cached at the detection resolution, masks are upsampled inside their boxes only
+    sizes = [(array.shape[1], array.shape[0]) for array in arrays]
+    return [output.resize(downscaled_size(size, max_side), size) for output, size in zip(outputs, sizes)]
+
+
+def downscaled_size(size, max_side):
+    width, height = size
+    if max_side <= 0 or max(width, height) <= max_side:
+        return size
+    scale = max_side / max(width, height)
+    return max(round(width * scale), 1), max(round(height * scale), 1)
+
+
+def downscale(array, max_side):
+    size = downscaled_size((array.shape[1], array.shape[0]), max_side)
+    if size == (array.shape[1], array.shape[0]):
+        return array
+    return cv2.resize(array, size, interpolation=cv2.INTER_AREA)
+
+
+def run_detector(model, info, arrays, batch_size=None):
+    batch_size = batch_size or opts.dd_detect_batch_size
+    # on CPU, single-stage models run their network through ONNX Runtime when it is installed
+    if opts.dd_onnx_cpu and get_device() == "cpu" and onnx_backend.available() and single_stage(model):
+        session = onnx_sessions.get(model, info.path)
+        if session is not None:
+            return onnx_backend.detect(model, session, arrays, batch_size)
+    if opts.dd_compiled_detector and single_stage(model):
+        key = f"{info.short_hash}-{config_hash(info)[:10]}"
+        return compiled.detect(model, compiled_networks, key, arrays, batch_size)
+    return detect(model, arrays, batch_size)
+
+
+def inference_mmdet_segm(arrays, modelname, conf_thres, label):
+    from mmdet.evaluation import get_classes
+
+    outputs = detector_outputs(modelname, arrays, conf_thres)
     dataset = modeldataset(modelname)
     classes = get_classes(dataset)
 
-    n, m = bboxes.shape
-    if n == 0:
-        return [[], [], [], []]
-    labels = mmdet_results.labels
-    filter_inds = np.where(scores > conf_thres)[0]
-    results = [[], [], [], []]
-    for i in filter_inds:
-        results[0].append(label + "-" + classes[labels[i]])
-        results[1].append(bboxes[i])
-        results[2].append(segms[i])
-        results[3].append(scores[i])
+    all_results = []
+    for output in outputs:
+        filter_inds = np.where(output.scores > conf_thres)[0]
+        results = [[], [], [], []]
+        for i in filter_inds:
+            results[0].append(label + "-" + classes[output.labels[i]])
+            results[1].append(output.bboxes[i])
+            results[2].append(output.masks[i])
+            results[3].append(output.scores[i])
+        all_results.append(results)
+
+    return all_results
+
+
+def inference_mmdet_bbox(arrays, modelname, conf_thres, label):
+    outputs = detector_outputs(modelname, arrays, conf_thres)
+
+    all_results = []
+    for output in outputs:
+        # bbox detections stay coordinates; pixels are drawn only for the masks that survive
+        filter_inds = np.where(output.scores > conf_thres)[0]
+        results = [[], [], [], []]
+        for i in filter_inds:
+            results[0].append(label)
+            results[1].append(output.bboxes[i])
+            results[2].append(None)
+            results[3].append(output.scores[i])
+        all_results.append(results)
+
+    return all_results
+
+
+class DetectRequest(BaseModel):
+    images: List[str] = Field(description="Base64 encoded images, detected as one batch")
+    model_a: str = "None"
+    conf_a: float = 30
+    dilation_a: int = 4
+    offset_x_a: int = 0
+    offset_y_a: int = 0
+    bitwise_op: Literal["None", "A&B", "A-B"] = "None"
+    model_b: str = "None"
+    conf_b: float = 30
+    dilation_b: int = 4
+    offset_x_b: int = 0
+    offset_y_b: int = 0
+
+
+def api_detect(request: DetectRequest):
+    from fastapi import HTTPException
+
+    from modules.api.api import decode_base64_to_image
+
+    startup()
+    for name in (request.model_a, request.model_b):
+        if name != "None" and registry.get(name) is None:
+            raise HTTPException(status_code=404, detail=f"model {name!r} not found")
+    try:
+        images = [decode_base64_to_image(image).convert("RGB") for image in request.images]
+    except Exception as e:
+        raise HTTPException(status_code=400, detail="invalid encoded image") from e
+    use_a = request.model_a != "None"
+    use_b = request.model_b != "None"
+    use_bitwise = use_a and use_b and request.bitwise_op != "None"
+    jobs = []
+    if use_a:
+        model_a = (request.model_a, request.conf_a, request.dilation_a, request.offset_x_a, request.offset_y_a)
+        jobs.append((*model_a, request.bitwise_op if use_bitwise else "A"))
+    if use_b:
+        jobs.append((request.model_b, request.conf_b, request.dilation_b, request.offset_x_b, request.offset_y_b, "B"))
+    detections = detect_masks_concurrently(images, *jobs) if jobs else []
+
+    response = []
+    for i, image in enumerate(images):
+        per_model = [job_detections[i] for job_detections in detections]
+        if use_bitwise:
+            # the same masking as run(): only the combination of A with B is returned
+            (results_a, masks_a), (_, masks_b) = per_model
+            per_model = []
+            if len(masks_b) > 0:
+                masks_a, keep = bitwise_masks(masks_a, masks_b, request.bitwise_op)
+                per_model = [(select_results(results_a, keep), masks_a)]
+        found = [
+            {
+                "label": label,
+                "score": float(score),
+                "bbox": [float(v) for v in bbox],
+                "box": list(mask.tight_box()),
+                "mask": mask.rle(),
+            }
+            for results, masks in per_model
+            for label, bbox, score, mask in zip(results[0], results[1], results[3], masks)
+        ]
+        response.append({"width": image.width, "height": image.height, "detections": found})
+    return {"images": response}
 
-    return results
 
+def api_metrics():
+    from fastapi.responses import PlainTextResponse
 
-def inference_mmdet_bbox(image, modelname, conf_thres, label):
-    model_checkpoint = modelpath(modelname)
-    model_config = os.path.splitext(model_checkpoint)[0] + ".py"
-    model_device = get_device()
-    model = init_detector(model_config, model_checkpoint, device=model_device)
-    output = inference_detector(model, np.array(image)).pred_instances
-    cv2_image = np.array(image)
-    cv2_image = cv2_image[:, :, ::-1].copy()
-    cv2_gray = cv2.cvtColor(cv2_image, cv2.COLOR_BGR2GRAY)
-
-    segms = []
-    for x0, y0, x1, y1 in output.bboxes:
-        cv2_mask = np.zeros((cv2_gray.shape), np.uint8)
-        cv2.rectangle(cv2_mask, (int(x0), int(y0)), (int(x1), int(y1)), 255, -1)
-        cv2_mask_bool = cv2_mask.astype(bool)
-        segms.append(cv2_mask_bool)
-
-    n, m = output.bboxes.shape
-    if n == 0:
-        return [[], [], [], []]
-    bboxes = output.bboxes.cpu().numpy()
-    scores = output.scores.cpu().numpy()
-    filter_inds = np.where(scores > conf_thres)[0]
-    results = [[], [], [], []]
-    for i in filter_inds:
-        results[0].append(label)
-        results[1].append(bboxes[i])
-        results[2].append(segms[i])
-        results[3].append(scores[i])
+    # cumulative since the webui started, in the Prometheus text format
+    return PlainTextResponse(metrics.counters.prometheus(), media_type="text/plain; version=0.0.4")
 
-    return results
+
+def api_dependencies():
+    # the same HTTP basic auth as the webui's own API routes, when it is started with --api-auth
+    from secrets import compare_digest
+
+    from fastapi import Depends, HTTPException
+    from fastapi.security import HTTPBasic, HTTPBasicCredentials
+
+    if not cmd_opts.api_auth:
+        return []
+    credentials = dict(auth.split(":", 1) for auth in cmd_opts.api_auth.split(","))
+
+    def auth(given: HTTPBasicCredentials = Depends(HTTPBasic())):  # noqa: B008
+        password = credentials.get(given.username)
+        if password is not None and compare_digest(given.password, password):
+            return True
+        raise HTTPException(
+            status_code=401, detail="Incorrect username or password", headers={"WWW-Authenticate": "Basic"}
+        )
+
+    return [Depends(auth)]
+
+
+def add_api_routes(_, app):
+    dependencies = api_dependencies()
+    app.add_api_route(
+        "/dddetailer/v1/models", lambda: {"models": registry.titles()}, methods=["GET"], dependencies=dependencies
+    )
+    app.add_api_route("/dddetailer/v1/detect", api_detect, methods=["POST"], dependencies=dependencies)
+    app.add_api_route("/dddetailer/v1/metrics", api_metrics, methods=["GET"], dependencies=dependencies)
 
 
 script_callbacks.on_ui_settings(on_ui_settings)
+script_callbacks.on_app_started(warmup)
+script_callbacks.on_app_started(add_api_routes)
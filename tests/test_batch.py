@@ -0,0 +1,134 @@
+import base64
+import io
+import json
+import threading
+import urllib.error
+
+import numpy as np
+import pytest
+from PIL import Image
+
+from dddetailer import batch
+
+
+def write_image(path, size=(8, 6)):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    Image.new("RGB", size).save(path)
+
+
+def test_collect_inputs_from_directory_and_glob(tmp_path):
+    write_image(tmp_path / "b.png")
+    write_image(tmp_path / "a" / "c.jpg")
+    (tmp_path / "notes.txt").write_text("")
+
+    root, paths = batch.collect_inputs(str(tmp_path))
+    assert root == str(tmp_path)
+    assert paths == [str(tmp_path / "b.png"), str(tmp_path / "a" / "c.jpg")]
+
+    root, paths = batch.collect_inputs(str(tmp_path / "**" / "*.*"))
+    assert root == str(tmp_path)
+    assert sorted(paths) == sorted([str(tmp_path / "b.png"), str(tmp_path / "a" / "c.jpg")])
+
+
+def test_pending_skips_existing_outputs(tmp_path):
+    inputs = [str(tmp_path / "in" / "x.jpg"), str(tmp_path / "in" / "sub" / "y.webp")]
+    out = tmp_path / "out"
+    write_image(out / "x.png")
+    jobs = batch.pending(str(tmp_path / "in"), inputs, str(out))
+    assert jobs == [(inputs[1], str(out / "sub" / "y.png"))]
+
+
+def test_prefetch_keeps_order_and_bounds_lookahead():
+    loaded = []
+    release = threading.Event()
+
+    def load(item):
+        loaded.append(item)
+        if item == 0:
+            release.wait(5)
+        return item * 10
+
+    results = batch.prefetch(range(10), load, depth=3)
+    # nothing past the depth is loaded while the first item is still pending
+    first = threading.Timer(0.2, release.set)
+    first.start()
+    assert next(results) == (0, 0)
+    assert len(loaded) <= 4
+    assert list(results) == [(i, i * 10) for i in range(1, 10)]
+
+
+class Response(io.BytesIO):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+@pytest.fixture()
+def webui(monkeypatch):
+    """A fake webui API: records the requests and answers img2img and detect."""
+    requests = []
+
+    def urlopen(request, timeout=None):
+        payload = json.loads(request.data)
+        requests.append((request.full_url, payload, request.get_header("Authorization"), timeout))
+        if payload.get("width") == 13:
+            raise urllib.error.URLError("timed out")
+        if request.full_url.endswith("/dddetailer/v1/detect"):
+            # one 2x2 detection at (1, 1) on a 4x3 canvas, column-major runs
+            rle = {"size": [3, 4], "counts": [4, 2, 1, 2, 3]}
+            images = [{"width": 4, "height": 3, "detections": [{"mask": rle}]}]
+            return Response(json.dumps({"images": images}).encode())
+        buffer = io.BytesIO()
+        Image.new("RGB", (4, 4)).save(buffer, format="PNG")
+        return Response(json.dumps({"images": [base64.b64encode(buffer.getvalue()).decode()]}).encode())
+
+    monkeypatch.setattr(batch.urllib.request, "urlopen", urlopen)
+    return requests
+
+
+def img2img_payloads(requests):
+    return [payload for url, payload, _, _ in requests if url.endswith("/img2img")]
+
+
+def test_main_sends_each_image_at_its_own_size(tmp_path, webui):
+    write_image(tmp_path / "in" / "wide.png", (40, 20))
+    write_image(tmp_path / "in" / "tall.png", (20, 40))
+    batch.main([str(tmp_path / "in"), str(tmp_path / "out")])
+    assert [(p["width"], p["height"]) for p in img2img_payloads(webui)] == [(20, 40), (40, 20)]
+    assert (tmp_path / "out" / "wide.png").exists()
+
+    webui.clear()
+    batch.main([str(tmp_path / "in"), str(tmp_path / "out2"), "--width", "512"])
+    assert [(p["width"], p["height"]) for p in img2img_payloads(webui)] == [(512, 40), (512, 20)]
+
+
+def test_main_writes_masks_with_auth_and_timeout(tmp_path, webui):
+    write_image(tmp_path / "in" / "sub" / "a.png")
+    args = [str(tmp_path / "in"), str(tmp_path / "out"), "--model-a", "bbox/face.pth"]
+    batch.main([*args, "--auth", "user:secret", "--timeout", "30"])
+
+    urls = [url.rsplit("/", 1)[-1] for url, _, _, _ in webui]
+    assert urls == ["detect", "img2img"]
+    expected_auth = "Basic " + base64.b64encode(b"user:secret").decode()
+    assert all(auth == expected_auth and timeout == 30 for _, _, auth, timeout in webui)
+    with Image.open(tmp_path / "out" / "masks" / "sub" / "a.png") as mask:
+        expected = np.zeros((3, 4), dtype=bool)
+        expected[1:3, 1:3] = True
+        np.testing.assert_array_equal(np.array(mask), expected)
+
+
+def test_decode_rle_is_column_major():
+    mask = batch.decode_rle({"size": [2, 3], "counts": [1, 2, 3]})
+    np.testing.assert_array_equal(mask, [[False, True, False], [True, False, False]])
+
+
+def test_failed_request_skips_only_its_image(tmp_path, webui, capsys):
+    # the fake webui fails every request for an image 13 pixels wide
+    write_image(tmp_path / "in" / "a.png", (13, 6))
+    write_image(tmp_path / "in" / "b.png")
+    batch.main([str(tmp_path / "in"), str(tmp_path / "out")])
+    assert not (tmp_path / "out" / "a.png").exists()
+    assert (tmp_path / "out" / "b.png").exists()
+    assert "1 failed" in capsys.readouterr().out
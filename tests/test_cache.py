@@ -0,0 +1,101 @@
+import os
+
+import numpy as np
+import pytest
+
+pytest.importorskip("torch")
+
+from dddetailer.cache import DetectionCache  # noqa: E402
+from dddetailer.detector import Detections  # noqa: E402
+from dddetailer.mask import Mask  # noqa: E402
+
+SIZE = (64, 48)
+
+
+def make_detections():
+    rng = np.random.default_rng(0)
+    bitmap = rng.random((9, 13)) > 0.5
+    return Detections(
+        labels=np.array([0, 1, 0]),
+        bboxes=np.array([[1, 2, 10, 12], [20, 5, 40, 30], [0, 0, 5, 5]], dtype=np.float32),
+        scores=np.array([0.9, 0.5, 0.2], dtype=np.float32),
+        masks=[Mask((3, 4, 16, 13), SIZE, bitmap), Mask((20, 5, 41, 31), SIZE), None],
+        score_thr=0.1,
+        max_per_img=10,
+    )
+
+
+def assert_same(a, b):
+    np.testing.assert_array_equal(a.labels, b.labels)
+    np.testing.assert_array_equal(a.bboxes, b.bboxes)
+    np.testing.assert_array_equal(a.scores, b.scores)
+    assert (a.score_thr, a.max_per_img) == (b.score_thr, b.max_per_img)
+    assert len(a.masks) == len(b.masks)
+    for x, y in zip(a.masks, b.masks):
+        if x is None:
+            assert y is None
+            continue
+        assert x.box == y.box
+        assert x.is_rect == y.is_rect
+        np.testing.assert_array_equal(x.to_array(), y.to_array())
+
+
+def test_disabled_cache_stores_nothing(tmp_path):
+    cache = DetectionCache(str(tmp_path))
+    cache.put("ab" * 20, make_detections())
+    assert cache.get("ab" * 20) is None
+    assert not any(tmp_path.iterdir())
+
+
+def test_round_trip(tmp_path):
+    cache = DetectionCache(str(tmp_path), max_bytes=1 << 20)
+    key = DetectionCache.key(np.zeros((4, 4, 3), np.uint8), "model", "config")
+    detections = make_detections()
+    cache.put(key, detections)
+    assert_same(cache.get(key), detections)
+
+
+def test_key_depends_on_content_and_parts():
+    array = np.zeros((4, 4, 3), np.uint8)
+    other = array.copy()
+    other[0, 0, 0] = 1
+    key = DetectionCache.key(array, "model", 0)
+    assert key == DetectionCache.key(array.copy(), "model", 0)
+    assert key != DetectionCache.key(other, "model", 0)
+    assert key != DetectionCache.key(array, "model", 512)
+    assert key != DetectionCache.key(array.reshape(2, 8, 3), "model", 0)
+
+
+def test_damaged_entry_is_dropped(tmp_path):
+    cache = DetectionCache(str(tmp_path), max_bytes=1 << 20)
+    key = "cd" * 20
+    cache.put(key, make_detections())
+    path = cache._path(key)
+    with open(path, "wb") as f:
+        f.write(b"not an npz")
+    assert cache.get(key) is None
+    assert not os.path.exists(path)
+
+
+def test_evicts_least_recently_used(tmp_path):
+    cache = DetectionCache(str(tmp_path), max_bytes=1 << 20)
+    keys = [f"{i:02x}" * 20 for i in range(3)]
+    for i, key in enumerate(keys):
+        cache.put(key, make_detections())
+        os.utime(cache._path(key), (1000 + i, 1000 + i))
+    size = os.path.getsize(cache._path(keys[0]))
+    # a hit makes the oldest entry the most recent one
+    assert cache.get(keys[0]) is not None
+    cache.max_bytes = 2 * size
+    assert cache.evict() == 1
+    assert cache.get(keys[1]) is None
+    assert cache.get(keys[0]) is not None
+    assert cache.get(keys[2]) is not None
+
+
+def test_clear(tmp_path):
+    cache = DetectionCache(str(tmp_path), max_bytes=1 << 20)
+    for i in range(3):
+        cache.put(f"{i:02x}" * 20, make_detections())
+    assert cache.clear() == 3
+    assert cache.get("00" * 20) is None
@@ -0,0 +1,80 @@
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+
+pytest.importorskip("torch")
+
+from dddetailer.detector import Detections, limits  # noqa: E402
+from dddetailer.mask import Mask  # noqa: E402
+
+
+def make(scores, score_thr=0.0, max_per_img=0):
+    n = len(scores)
+    return Detections(
+        labels=np.zeros(n, dtype=np.int64),
+        bboxes=np.arange(n * 4, dtype=np.float32).reshape(n, 4),
+        scores=np.array(scores, dtype=np.float32),
+        masks=[None] * n,
+        score_thr=score_thr,
+        max_per_img=max_per_img,
+    )
+
+
+def test_limit_keeps_the_best_scores_in_order():
+    detections = make([0.2, 0.9, 0.5, 0.7, 0.1])
+    limited = detections.limit(0.3, 2)
+    np.testing.assert_array_equal(limited.scores, np.array([0.9, 0.7], np.float32))
+    np.testing.assert_array_equal(limited.bboxes, detections.bboxes[[1, 3]])
+    assert (limited.score_thr, limited.max_per_img) == (0.3, 2)
+    assert detections.limit(0.0, 0) is detections
+
+
+def test_unlimited_entry_serves_any_threshold_and_cap():
+    unlimited = make([0.2, 0.9, 0.5])
+    for score_thr, max_per_img in ((0.0, 0), (0.1, 5), (0.6, 1)):
+        assert unlimited.covers(score_thr, max_per_img)
+        expected = sorted(s for s in unlimited.scores if s > score_thr)[::-1][: max_per_img or None]
+        assert sorted(unlimited.limit(score_thr, max_per_img).scores)[::-1] == expected
+
+
+def test_limited_entry_only_covers_stricter_requests():
+    limited = make([0.9, 0.5], score_thr=0.3, max_per_img=2)
+    assert limited.covers(0.3, 2)
+    assert limited.covers(0.5, 1)
+    assert not limited.covers(0.2, 2)
+    assert not limited.covers(0.3, 3)
+    assert not limited.covers(0.3, 0)
+
+
+def test_limits_tightens_and_restores_test_cfg():
+    bbox_cfg = {"score_thr": 0.05, "max_per_img": 100}
+    fusion_cfg = {"iou_thr": 0.8}
+    model = SimpleNamespace(
+        bbox_head=SimpleNamespace(test_cfg=bbox_cfg),
+        panoptic_fusion_head=SimpleNamespace(test_cfg=fusion_cfg),
+    )
+    with limits(model, 0.3, 10):
+        assert bbox_cfg == {"score_thr": 0.3, "max_per_img": 10}
+        assert fusion_cfg == {"iou_thr": 0.8, "max_per_image": 10}
+    assert bbox_cfg == {"score_thr": 0.05, "max_per_img": 100}
+    assert fusion_cfg == {"iou_thr": 0.8}
+
+    # the config's own limits are never loosened
+    with limits(model, 0.0, 0):
+        assert bbox_cfg == {"score_thr": 0.05, "max_per_img": 100}
+        assert fusion_cfg == {"iou_thr": 0.8}
+
+
+def test_resize_scales_boxes_and_masks_per_axis():
+    src, size = (100, 50), (300, 75)
+    detections = make([0.9, 0.5])
+    detections.bboxes = np.array([[10, 10, 20, 30], [0, 0, 100, 50]], np.float32)
+    detections.masks = [Mask((10, 10, 20, 30), src), None]
+    resized = detections.resize(src, size)
+    np.testing.assert_allclose(resized.bboxes, [[30, 15, 60, 45], [0, 0, 300, 75]])
+    assert resized.masks[0].size == size
+    assert resized.masks[0].box == (30, 15, 60, 45)
+    assert resized.masks[1] is None
+    np.testing.assert_array_equal(resized.scores, detections.scores)
+    assert detections.resize(src, src) is detections
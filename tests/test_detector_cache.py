@@ -0,0 +1,140 @@
+import threading
+import time
+
+import pytest
+
+pytest.importorskip("torch")
+
+from dddetailer.detector import DetectorCache  # noqa: E402
+
+
+class FakeModel:
+    def __init__(self, name):
+        self.name = name
+        self.device = "cuda"
+
+    def to(self, device):
+        self.device = device
+        return self
+
+
+class FakeCache(DetectorCache):
+    def __init__(self, max_size=2, delay=0.0):
+        super().__init__(max_size)
+        self.delay = delay
+        self.loads = []
+
+    def _load(self, config, checkpoint, device):
+        self.loads.append(checkpoint)
+        time.sleep(self.delay)
+        return FakeModel(checkpoint)
+
+
+@pytest.fixture()
+def checkpoints(tmp_path):
+    paths = []
+    for name in ("a", "b", "c"):
+        path = tmp_path / f"{name}.pth"
+        path.write_bytes(b"")
+        paths.append(str(path))
+    return paths
+
+
+def get(cache, checkpoint, device="cpu"):
+    with cache.lease("x.py", checkpoint, device) as model:
+        return model
+
+
+def test_hit_does_not_reload(checkpoints):
+    cache = FakeCache()
+    first = get(cache, checkpoints[0])
+    assert get(cache, checkpoints[0]) is first
+    assert cache.loads == [checkpoints[0]]
+
+
+def test_eviction_moves_model_to_cpu(checkpoints):
+    cache = FakeCache(max_size=1)
+    first = get(cache, checkpoints[0], "cuda")
+    get(cache, checkpoints[1], "cuda")
+    assert len(cache) == 1
+    assert first.device == "cpu"
+
+
+def test_leased_model_is_released_by_its_last_lease(checkpoints):
+    cache = FakeCache(max_size=1)
+    with cache.lease("x.py", checkpoints[0], "cuda") as first:
+        with cache.lease("x.py", checkpoints[0], "cuda"):
+            # loading B evicts A while two detections still run on it
+            second = get(cache, checkpoints[1], "cuda")
+            assert len(cache) == 1
+        assert first.device == "cuda"
+    assert first.device == "cpu"
+    assert second.device == "cuda"
+
+
+def test_eviction_during_a_concurrent_lease(checkpoints):
+    cache = FakeCache(max_size=1)
+    in_use = threading.Event()
+    done = threading.Event()
+    devices = []
+
+    def detect():
+        with cache.lease("x.py", checkpoints[0], "cuda") as model:
+            in_use.set()
+            done.wait(5)
+            devices.append(model.device)
+
+    thread = threading.Thread(target=detect)
+    thread.start()
+    in_use.wait(5)
+    get(cache, checkpoints[1], "cuda")
+    done.set()
+    thread.join()
+    assert devices == ["cuda"]
+    assert cache.loads == checkpoints[:2]
+
+
+def test_clear_releases_models(checkpoints):
+    cache = FakeCache()
+    models = [get(cache, path, "cuda") for path in checkpoints[:2]]
+    assert cache.clear() == 2
+    assert len(cache) == 0
+    assert all(model.device == "cpu" for model in models)
+
+
+def test_concurrent_lookups_share_one_load(checkpoints):
+    cache = FakeCache(delay=0.2)
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(get(cache, checkpoints[0]))) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert cache.loads == [checkpoints[0]]
+    assert all(result is results[0] for result in results)
+
+
+def test_load_does_not_block_other_models(checkpoints):
+    cache = FakeCache(delay=0.5)
+    get(cache, checkpoints[0])
+    slow = threading.Thread(target=get, args=(cache, checkpoints[1]))
+    slow.start()
+    time.sleep(0.1)
+    start = time.perf_counter()
+    get(cache, checkpoints[0])
+    assert time.perf_counter() - start < 0.25
+    slow.join()
+
+
+def test_failed_load_is_not_cached(checkpoints):
+    class Failing(FakeCache):
+        def _load(self, config, checkpoint, device):
+            self.loads.append(checkpoint)
+            raise RuntimeError("broken checkpoint")
+
+    cache = Failing()
+    for _ in range(2):
+        with pytest.raises(RuntimeError):
+            get(cache, checkpoints[0])
+    assert cache.loads == [checkpoints[0]] * 2
+    assert len(cache) == 0
@@ -0,0 +1,204 @@
+import cv2
+import numpy as np
+import pytest
+
+from dddetailer.mask import (
+    LARGE_KERNEL,
+    Mask,
+    bitwise_and_masks,
+    bitwise_masks,
+    combine_masks,
+    dilate_bitmap,
+    dilate_masks,
+    group_masks,
+    offset_masks,
+    subtract_masks,
+    transform_masks,
+)
+
+SIZE = (96, 64)
+
+
+def random_masks(rng, count, rect_every=3):
+    masks = []
+    for i in range(count):
+        # some boxes start off the canvas, to exercise the clipping
+        x0, y0 = int(rng.integers(-8, SIZE[0] - 4)), int(rng.integers(-8, SIZE[1] - 4))
+        x1, y1 = x0 + int(rng.integers(1, 40)), y0 + int(rng.integers(1, 30))
+        if i % rect_every == 0:
+            masks.append(Mask((x0, y0, x1, y1), SIZE))
+        else:
+            bitmap = rng.random((y1 - y0, x1 - x0)) > 0.4
+            masks.append(Mask((x0, y0, x1, y1), SIZE, bitmap))
+    return masks
+
+
+@pytest.mark.parametrize("seed", range(5))
+@pytest.mark.parametrize("op", ["A&B", "A-B"])
+def test_bitwise_masks_matches_pairwise_ops(seed, op):
+    rng = np.random.default_rng(seed)
+    masks = random_masks(rng, 12)
+    masks_b = random_masks(rng, 3)
+    combined = combine_masks(masks_b)
+    single = bitwise_and_masks if op == "A&B" else subtract_masks
+
+    expected = [(i, single(mask, combined)) for i, mask in enumerate(masks)]
+    expected = [(i, mask) for i, mask in expected if not mask.is_empty()]
+    out, keep = bitwise_masks(masks, masks_b, op)
+
+    assert keep == [i for i, _ in expected]
+    for mask, (_, reference) in zip(out, expected):
+        np.testing.assert_array_equal(mask.to_array(), reference.to_array())
+
+
+def test_bitwise_masks_none_keeps_everything():
+    masks = random_masks(np.random.default_rng(0), 4)
+    assert bitwise_masks(masks, masks[:1], "None") == (masks, [0, 1, 2, 3])
+
+
+def test_bitwise_masks_disjoint():
+    a = Mask((0, 0, 10, 10), SIZE)
+    b = Mask((50, 50, 60, 60), SIZE)
+    assert bitwise_masks([a], [b], "A&B") == ([], [])
+    out, keep = bitwise_masks([a], [b], "A-B")
+    assert out == [a]
+    assert keep == [0]
+
+
+def test_combine_masks_is_union():
+    masks = random_masks(np.random.default_rng(1), 6)
+    expected = np.logical_or.reduce([mask.to_array() for mask in masks])
+    np.testing.assert_array_equal(combine_masks(masks).to_array(), expected)
+
+
+def test_from_array_is_crop_local():
+    array = np.zeros((SIZE[1], SIZE[0]), np.uint8)
+    cv2.ellipse(array, (40, 30), (12, 8), 0, 0, 360, 255, -1)
+    mask = Mask.from_array(array)
+    assert mask.box == (28, 22, 53, 39)
+    np.testing.assert_array_equal(mask.to_array(), array > 0)
+    np.testing.assert_array_equal(np.asarray(mask.to_image()), array)
+
+
+def full_frame_transform(array, dilation_factor, offset_x, offset_y):
+    # the original full-canvas dilate_masks followed by offset_masks, with clipping instead of wrapping
+    if dilation_factor > 1:
+        array = cv2.dilate(array.astype(np.uint8), np.ones((dilation_factor, dilation_factor), np.uint8)) > 0
+    height, width = array.shape
+    ys, xs = np.nonzero(array)
+    ys, xs = ys - offset_y, xs + offset_x
+    inside = (ys >= 0) & (ys < height) & (xs >= 0) & (xs < width)
+    out = np.zeros_like(array)
+    out[ys[inside], xs[inside]] = True
+    return out
+
+
+@pytest.mark.parametrize("dilation_factor", [2, 3, 4, 7, LARGE_KERNEL, LARGE_KERNEL + 1, 128])
+def test_dilate_bitmap_matches_cv2(dilation_factor):
+    bitmap = np.random.default_rng(dilation_factor).random((150, 170)) > 0.995
+    kernel = np.ones((dilation_factor, dilation_factor), np.uint8)
+    expected = cv2.dilate(bitmap.view(np.uint8), kernel) > 0
+    np.testing.assert_array_equal(dilate_bitmap(bitmap, dilation_factor), expected)
+
+
+@pytest.mark.parametrize("dilation_factor", [0, 1, 2, 5, 8, 33])
+@pytest.mark.parametrize(("offset_x", "offset_y"), [(0, 0), (7, -3), (-90, 4), (0, 70)])
+def test_transform_matches_full_frame(dilation_factor, offset_x, offset_y):
+    for mask in random_masks(np.random.default_rng(dilation_factor), 6):
+        expected = full_frame_transform(mask.to_array(), dilation_factor, offset_x, offset_y)
+        transformed = mask.transform(dilation_factor, offset_x, offset_y)
+        np.testing.assert_array_equal(transformed.to_array(), expected)
+        x0, y0, x1, y1 = transformed.box
+        assert 0 <= x0 <= x1 <= SIZE[0]
+        assert 0 <= y0 <= y1 <= SIZE[1]
+
+
+def test_transform_masks_is_dilate_then_offset():
+    masks = random_masks(np.random.default_rng(3), 5)
+    fused = transform_masks(masks, 6, 5, -4)
+    chained = offset_masks(dilate_masks(masks, 6), 5, -4)
+    for a, b in zip(fused, chained):
+        np.testing.assert_array_equal(a.to_array(), b.to_array())
+
+
+def decode_rle(rle):
+    height, width = rle["size"]
+    flat = np.zeros(height * width, dtype=bool)
+    position = 0
+    for i, count in enumerate(rle["counts"]):
+        flat[position : position + count] = i % 2 == 1
+        position += count
+    assert position == height * width
+    return flat.reshape(width, height).T
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_rle_decodes_to_the_mask(seed):
+    masks = random_masks(np.random.default_rng(seed), 12)
+    width, height = SIZE
+    masks += [
+        Mask((0, 0, width, height), SIZE),
+        Mask((0, 0, 1, 1), SIZE),
+        Mask((width - 1, height - 1, width, height), SIZE),
+        Mask((0, 0, 0, 0), SIZE),
+    ]
+    for mask in masks:
+        rle = mask.rle()
+        assert rle["size"] == [height, width]
+        assert all(count > 0 for count in rle["counts"][1:])
+        np.testing.assert_array_equal(decode_rle(rle), mask.to_array())
+
+
+@pytest.mark.parametrize("padding", [0, 4, 16])
+@pytest.mark.parametrize("seed", range(5))
+def test_group_masks_is_a_partition_without_overlap(seed, padding):
+    masks = random_masks(np.random.default_rng(seed), 20)
+    groups = group_masks(masks, padding)
+    assert sorted(i for group in groups for i in group) == list(range(len(masks)))
+    for group in groups:
+        assert group
+        for n, i in enumerate(group):
+            a = np.array(masks[i].box) + [-padding, -padding, padding, padding]
+            for k in group[n + 1 :]:
+                b = np.array(masks[k].box) + [-padding, -padding, padding, padding]
+                assert a[0] >= b[2] or b[0] >= a[2] or a[1] >= b[3] or b[1] >= a[3]
+
+
+def test_group_masks_edge_cases():
+    assert group_masks([]) == []
+    touching = [Mask((0, 0, 10, 10), SIZE), Mask((10, 0, 20, 10), SIZE)]
+    assert group_masks(touching) == [[0, 1]]
+    assert group_masks(touching, padding=1) == [[0], [1]]
+
+
+@pytest.mark.parametrize("size", [(180, 150), (45, 20), (200, 61), (91, 59)])
+@pytest.mark.parametrize("seed", range(5))
+def test_resize_matches_full_frame_resize(seed, size):
+    rng = np.random.default_rng(seed)
+    full = np.zeros(SIZE[::-1], dtype=np.uint8)
+    x0, y0 = int(rng.integers(0, SIZE[0] - 10)), int(rng.integers(0, SIZE[1] - 10))
+    full[y0 : y0 + 15, x0 : x0 + 20] = rng.random(full[y0 : y0 + 15, x0 : x0 + 20].shape) > 0.2
+    full = cv2.dilate(full, np.ones((5, 5), np.uint8))
+
+    resized = Mask.from_array(full).resize(size).to_array()
+    reference = (cv2.resize(full * 255, size, interpolation=cv2.INTER_LINEAR) > 127).astype(np.uint8)
+    # resampling the crop instead of the frame only moves pixels on the mask's edge
+    kernel = np.ones((3, 3), np.uint8)
+    edge = cv2.dilate(reference, kernel) > cv2.erode(reference, kernel, borderType=cv2.BORDER_REPLICATE)
+    assert not ((resized != reference.astype(bool)) & ~edge).any()
+
+
+def test_resize_scales_rect_boxes_outwards():
+    mask = Mask((3, 5, 10, 20), SIZE).resize((SIZE[0] * 2, SIZE[1] // 2))
+    assert mask.box == (6, 2, 20, 10)
+    assert mask.is_rect
+
+
+def test_from_box_matches_cv2_rectangle():
+    rng = np.random.default_rng(0)
+    for _ in range(2000):
+        x0, x1 = np.sort(rng.uniform(-20, SIZE[0] + 20, 2))
+        y0, y1 = np.sort(rng.uniform(-20, SIZE[1] + 20, 2))
+        reference = np.zeros(SIZE[::-1], dtype=np.uint8)
+        cv2.rectangle(reference, (int(x0), int(y0)), (int(x1), int(y1)), 255, -1)
+        np.testing.assert_array_equal(Mask.from_box((x0, y0, x1, y1), SIZE).to_array(), reference > 0)
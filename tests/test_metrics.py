@@ -0,0 +1,84 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from dddetailer import metrics
+
+
+def test_stage_records_into_the_current_run_only():
+    run = metrics.Run()
+    with metrics.stage("outside"):
+        pass
+    with metrics.running(run):
+        with metrics.stage("detect"):
+            pass
+        assert metrics.current.get() is run
+    assert metrics.current.get() is None
+    assert list(run.summary()["stages"]) == ["detect"]
+
+
+def test_running_resets_after_an_error():
+    try:
+        with metrics.running(metrics.Run()):
+            raise RuntimeError
+    except RuntimeError:
+        pass
+    assert metrics.current.get() is None
+
+
+def test_concurrent_runs_are_isolated():
+    runs = [metrics.Run() for _ in range(4)]
+    barrier = threading.Barrier(len(runs))
+
+    def work(i):
+        with metrics.running(runs[i]):
+            barrier.wait(5)
+            for _ in range(i + 1):
+                with metrics.stage("inpaint"):
+                    pass
+
+    threads = [threading.Thread(target=work, args=(i,)) for i in range(len(runs))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert [run.stages["inpaint"]["count"] for run in runs] == [1, 2, 3, 4]
+
+
+def test_bind_carries_the_run_to_worker_threads():
+    run = metrics.Run()
+    with ThreadPoolExecutor(max_workers=1) as pool:
+        with metrics.running(run):
+            future = pool.submit(metrics.bind(metrics.timed("detect")(lambda: metrics.current.get())))
+        assert future.result() is run
+        # without bind the worker does not see it
+        with metrics.running(run):
+            assert pool.submit(metrics.current.get).result() is None
+    assert run.stages["detect"]["count"] == 1
+
+
+def test_infotext_since_snapshot_shows_the_delta():
+    run = metrics.Run()
+    run.add("detect", 1.0, 0.5)
+    run.add("inpaint", 2.0, 1.0)
+    mark = run.snapshot()
+    run.add("inpaint", 3.0, 1.0)
+    assert run.infotext() == "detect 1.00s, inpaint 5.00s"
+    assert run.infotext(mark) == "inpaint 3.00s"
+
+
+def test_stages_report_how_far_the_peaks_rose(monkeypatch):
+    peaks = {"rss": 100.0}
+    monkeypatch.setattr(metrics, "peak_rss_mb", lambda: peaks["rss"])
+    monkeypatch.setattr(metrics, "peak_device_mb", lambda: None)
+    run = metrics.Run()
+    with metrics.running(run):
+        with metrics.stage("detect"):
+            peaks["rss"] = 350.0
+        with metrics.stage("inpaint"):
+            pass
+    detect, inpaint = run.stages["detect"], run.stages["inpaint"]
+    assert (detect["rss_peak_mb"], detect["rss_peak_rise_mb"]) == (350.0, 250.0)
+    # the lifetime peak is still 350, but the stage did not raise it
+    assert (inpaint["rss_peak_mb"], inpaint["rss_peak_rise_mb"]) == (350.0, 0.0)
+    assert inpaint["device_peak_mb"] is None
+    assert inpaint["device_peak_rise_mb"] is None
@@ -0,0 +1,61 @@
+"""Parity of the ONNX Runtime detection path with mmdet on a fixture image.
+
+The model is the bundled anime-face YOLOv3 config. Its weights come from
+the checkpoint named by DDDETAILER_BBOX_CHECKPOINT, or are a seeded random
+initialization otherwise; parity does not depend on the weights.
+"""
+import os
+from pathlib import Path
+
+import numpy as np
+import pytest
+
+onnxruntime = pytest.importorskip("onnxruntime")
+pytest.importorskip("mmdet")
+
+import torch  # noqa: E402
+from PIL import Image  # noqa: E402
+
+from dddetailer import onnx_backend  # noqa: E402
+from dddetailer.detector import Detections, detect  # noqa: E402
+
+ROOT = Path(__file__).resolve().parents[1]
+# every one of the TOP best mmdet detections must have an ONNX one this close
+BOX_ATOL = 0.5  # pixels of the original image
+SCORE_ATOL = 1e-3
+TOP = 20
+
+
+@pytest.fixture(scope="module")
+def model():
+    from mmdet.apis import init_detector
+
+    torch.manual_seed(0)
+    checkpoint = os.environ.get("DDDETAILER_BBOX_CHECKPOINT")
+    return init_detector(str(ROOT / "config" / "mmdet_anime-face_yolov3.py"), checkpoint, device="cpu")
+
+
+@pytest.fixture(scope="module")
+def image():
+    with Image.open(ROOT / "misc" / "ddetailer_example_1.png") as img:
+        return np.array(img.convert("RGB"))
+
+
+def test_onnx_matches_mmdet(model, image, tmp_path):
+    path = str(tmp_path / "model.onnx")
+    onnx_backend.export(model, path)
+    session = onnxruntime.InferenceSession(path, providers=["CPUExecutionProvider"])
+
+    expected = Detections.from_instances(detect(model, [image])[0])
+    actual = Detections.from_instances(onnx_backend.detect(model, session, [image])[0])
+
+    assert len(expected) > 0
+    assert len(actual) == len(expected)
+    assert all(mask is None for mask in actual.masks)
+    for i in np.argsort(-expected.scores, kind="stable")[:TOP]:
+        close = (
+            (actual.labels == expected.labels[i])
+            & (np.abs(actual.scores - expected.scores[i]) <= SCORE_ATOL)
+            & (np.abs(actual.bboxes - expected.bboxes[i]).max(axis=1) <= BOX_ATOL)
+        )
+        assert close.any(), f"no ONNX detection matches {expected.bboxes[i]} scored {expected.scores[i]:.4f}"
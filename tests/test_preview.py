@@ -0,0 +1,70 @@
+import numpy as np
+import pytest
+from PIL import Image
+
+from dddetailer import preview
+from dddetailer.mask import Mask
+from dddetailer.preview import ALPHA, render_preview
+
+SIZE = (100, 60)
+
+
+@pytest.fixture()
+def texts(monkeypatch):
+    # record the labels instead of drawing them, so every painted pixel can be checked
+    calls = []
+    monkeypatch.setattr(preview.cv2, "putText", lambda array, text, org, *args: calls.append((text, org)))
+    return calls
+
+
+def render(masks, max_side=0, seed=0):
+    base = np.random.default_rng(seed).integers(0, 256, (SIZE[1], SIZE[0], 3), dtype=np.uint8)
+    np.random.seed(seed)
+    result = render_preview(Image.fromarray(base), ["face"] * len(masks), [0.875] * len(masks), masks, max_side)
+    np.random.seed(seed)
+    colors = np.random.randint(100, 256, (len(masks), 3), dtype=np.uint8)
+    return base, np.array(result), colors
+
+
+def blend(base, color):
+    return np.rint(base * ALPHA + color * (1 - ALPHA)).astype(np.uint8)
+
+
+def test_no_masks_returns_the_image():
+    image = Image.new("RGB", SIZE)
+    assert render_preview(image, [], [], []) is image
+
+
+def test_empty_mask_paints_nothing_and_labels_its_corner(texts):
+    base, result, _ = render([Mask((5, 8, 15, 20), SIZE, np.zeros((12, 10), dtype=bool))])
+    np.testing.assert_array_equal(result, base)
+    assert texts == [("face:0.87", (5 - 30, 8))]
+
+
+def test_box_clipped_at_the_canvas_edge(texts):
+    base, result, colors = render([Mask((90, 50, 130, 80), SIZE)])
+    expected = base.copy()
+    expected[50:60, 90:100] = blend(base[50:60, 90:100], colors[0])
+    np.testing.assert_array_equal(result, expected)
+    assert texts == [("face:0.87", (int(94.5) - 30, int(54.5)))]
+
+
+def test_overlapping_masks_take_the_last_colour(texts):
+    bitmap = np.zeros((20, 20), dtype=bool)
+    bitmap[5:15, 5:15] = True
+    masks = [Mask((0, 0, 30, 30), SIZE), Mask((20, 20, 40, 40), SIZE, bitmap)]
+    base, result, colors = render(masks)
+    expected = base.copy()
+    expected[0:30, 0:30] = blend(base[0:30, 0:30], colors[0])
+    expected[25:35, 25:35] = blend(base[25:35, 25:35], colors[1])
+    np.testing.assert_array_equal(result, expected)
+    assert [org for _, org in texts] == [(int(14.5) - 30, 14), (int(29.5) - 30, 29)]
+
+
+def test_max_side_draws_on_a_downscaled_copy(texts):
+    base, result, colors = render([Mask((10, 10, 50, 30), SIZE)], max_side=50)
+    assert result.shape == (30, 50, 3)
+    small = np.array(Image.fromarray(base).resize((50, 30), Image.BILINEAR))
+    expected = small.copy()
+    expected[5:15, 5:25] = blend(small[5:15, 5:25], colors[0])
+    np.testing.assert_array_equal(result, expected)
@@ -0,0 +1,109 @@
+import json
+import os
+
+import pytest
+
+from dddetailer.registry import INDEX_VERSION, ModelRegistry
+
+
+class CountingHash:
+    def __init__(self):
+        self.calls = []
+
+    def __call__(self, path):
+        self.calls.append(path)
+        with open(path, "rb") as f:
+            return f"{sum(f.read()) % 65536:08x}"
+
+
+@pytest.fixture()
+def root(tmp_path):
+    for relpath, data in [("bbox/face.pth", b"face"), ("segm/person.pth", b"person"), ("segm/person.py", b"")]:
+        path = tmp_path / relpath
+        path.parent.mkdir(exist_ok=True)
+        path.write_bytes(data)
+    return tmp_path
+
+
+def touch_dir(path):
+    # directory mtimes have a coarse resolution on some filesystems
+    st = os.stat(path)
+    os.utime(path, ns=(st.st_atime_ns, st.st_mtime_ns + 1_000_000_000))
+
+
+def test_titles_and_kinds(root):
+    registry = ModelRegistry(str(root), CountingHash())
+    titles = registry.titles()
+    assert [title.split(" ")[0] for title in titles] == [
+        os.path.join("bbox", "face.pth"),
+        os.path.join("segm", "person.pth"),
+    ]
+    face = registry.get(titles[0])
+    assert face.kind == "bbox"
+    assert face.name == "face"
+    assert face.config == str(root / "bbox" / "face.py")
+    assert registry.get(titles[1]).kind == "segm"
+
+
+def test_lookup_by_hash(root):
+    registry = ModelRegistry(str(root), CountingHash())
+    info = registry.get(registry.titles()[0])
+    assert registry.get(f"renamed.pth [{info.short_hash}]") is info
+
+
+def test_index_skips_rehashing(root):
+    first = CountingHash()
+    ModelRegistry(str(root), first).refresh()
+    assert len(first.calls) == 2
+
+    second = CountingHash()
+    registry = ModelRegistry(str(root), second)
+    registry.refresh()
+    assert second.calls == []
+
+    (root / "bbox" / "face.pth").write_bytes(b"new face weights")
+    registry.refresh()
+    assert second.calls == [str(root / "bbox" / "face.pth")]
+
+
+def test_old_index_version_is_rebuilt(root):
+    ModelRegistry(str(root), CountingHash()).refresh()
+    index = root / ".dddetailer-index.json"
+    data = json.loads(index.read_text())
+    assert data["version"] == INDEX_VERSION
+    data["version"] = INDEX_VERSION - 1
+    index.write_text(json.dumps(data))
+
+    hash_fn = CountingHash()
+    ModelRegistry(str(root), hash_fn).refresh()
+    assert len(hash_fn.calls) == 2
+
+
+def test_miss_does_not_rescan_unchanged_directories(root, monkeypatch):
+    registry = ModelRegistry(str(root), CountingHash())
+    registry.titles()
+    refreshes = []
+    monkeypatch.setattr(registry, "refresh", lambda: refreshes.append(1))
+    assert registry.get("missing.pth [deadbeef]") is None
+    assert refreshes == []
+
+
+def test_miss_rescans_after_a_file_is_added(root):
+    registry = ModelRegistry(str(root), CountingHash())
+    registry.titles()
+    (root / "bbox" / "hand.pth").write_bytes(b"hand")
+    touch_dir(root / "bbox")
+    info = registry.get(f"{os.path.join('bbox', 'hand.pth')} [{CountingHash()(str(root / 'bbox' / 'hand.pth'))}]")
+    assert info is not None
+    assert info.path == str(root / "bbox" / "hand.pth")
+
+
+def test_known_titles_never_hashes(root):
+    ModelRegistry(str(root), CountingHash()).refresh()
+    hash_fn = CountingHash()
+    registry = ModelRegistry(str(root), hash_fn)
+    assert len(registry.known_titles()) == 2
+    (root / "bbox" / "face.pth").unlink()
+    assert len(registry.known_titles()) == 1
+    assert hash_fn.calls == []
+    assert ModelRegistry(str(root / "empty"), hash_fn).known_titles() == []
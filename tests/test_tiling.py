@@ -0,0 +1,123 @@
+import numpy as np
+import pytest
+
+pytest.importorskip("torch")
+
+from dddetailer.detector import Detections  # noqa: E402
+from dddetailer.mask import Mask  # noqa: E402
+from dddetailer.tiling import MERGE_THRESHOLD, detect_tiled, merge_detections, tile_boxes  # noqa: E402
+
+SIZE = (200, 160)
+
+
+def reference_merge(parts):
+    # the pairwise loop merge_detections replaced
+    tiles = [i for i, part in enumerate(parts) for _ in range(len(part))]
+    labels = [label for part in parts for label in part.labels]
+    bboxes = [bbox for part in parts for bbox in np.asarray(part.bboxes).reshape(-1, 4)]
+    scores = np.concatenate([part.scores for part in parts])
+    masks = [mask for part in parts for mask in part.masks]
+
+    def overlap(i, k):
+        if masks[i] is None or masks[k] is None:
+            a, b = bboxes[i], bboxes[k]
+            inter = max(min(a[2], b[2]) - max(a[0], b[0]), 0) * max(min(a[3], b[3]) - max(a[1], b[1]), 0)
+            areas = ((a[2] - a[0]) * (a[3] - a[1]), (b[2] - b[0]) * (b[3] - b[1]))
+        else:
+            inter = np.count_nonzero(masks[i].to_array() & masks[k].to_array())
+            areas = (masks[i].area, masks[k].area)
+        return min(areas) > 0 and inter / min(areas) > MERGE_THRESHOLD
+
+    kept = []
+    for i in np.argsort(-scores, kind="stable"):
+        if not any(tiles[k] != tiles[i] and labels[k] == labels[i] and overlap(i, k) for k in kept):
+            kept.append(i)
+    return sorted(kept)
+
+
+def random_part(rng, count, with_masks):
+    bboxes, masks = [], []
+    for _ in range(count):
+        x0, y0 = int(rng.integers(0, SIZE[0] - 20)), int(rng.integers(0, SIZE[1] - 20))
+        x1, y1 = x0 + int(rng.integers(5, 40)), y0 + int(rng.integers(5, 40))
+        bboxes.append([x0, y0, x1, y1])
+        if with_masks:
+            bitmap = rng.random((y1 - y0, x1 - x0)) > 0.3
+            masks.append(Mask((x0, y0, x1, y1), SIZE, bitmap))
+        else:
+            masks.append(None)
+    return Detections(
+        labels=rng.integers(0, 2, count),
+        bboxes=np.array(bboxes, dtype=np.float32).reshape(-1, 4),
+        scores=rng.random(count).astype(np.float32),
+        masks=masks,
+    )
+
+
+@pytest.mark.parametrize("with_masks", [True, False])
+@pytest.mark.parametrize("seed", range(4))
+def test_merge_matches_pairwise_reference(seed, with_masks):
+    rng = np.random.default_rng(seed)
+    parts = [random_part(rng, 15, with_masks) for _ in range(4)]
+    merged = merge_detections(parts)
+    scores = np.concatenate([part.scores for part in parts])
+    np.testing.assert_array_equal(merged.scores, scores[reference_merge(parts)])
+
+
+def test_merge_keeps_the_best_scored_duplicate():
+    box = (10, 10, 50, 50)
+    parts = [
+        Detections(np.array([0]), np.array([box], np.float32), np.array([0.6], np.float32), [Mask(box, SIZE)]),
+        Detections(np.array([0]), np.array([box], np.float32), np.array([0.9], np.float32), [Mask(box, SIZE)]),
+        # the same label in the same tile is never merged, another label never either
+        Detections(
+            np.array([0, 1]),
+            np.array([box, box], np.float32),
+            np.array([0.5, 0.4], np.float32),
+            [Mask(box, SIZE), Mask(box, SIZE)],
+        ),
+    ]
+    merged = merge_detections(parts)
+    np.testing.assert_array_equal(merged.scores, np.array([0.9, 0.4], np.float32))
+    np.testing.assert_array_equal(merged.labels, [0, 1])
+
+
+def test_tile_boxes_cover_the_canvas_with_overlap():
+    boxes = tile_boxes((1000, 700), 512, 128)
+    covered = np.zeros((700, 1000), bool)
+    for x0, y0, x1, y1 in boxes:
+        assert x1 - x0 <= 512
+        assert y1 - y0 <= 512
+        covered[y0:y1, x0:x1] = True
+    assert covered.all()
+    xs = sorted({box[0] for box in boxes})
+    assert all(b - a <= 512 - 128 for a, b in zip(xs, xs[1:]))
+    assert tile_boxes((300, 200), 512, 128) == [(0, 0, 300, 200)]
+
+
+class FakeInstances(dict):
+    # the parts of mmdet's InstanceData that Detections.from_instances reads
+    def __init__(self, labels, bboxes, scores):
+        import torch
+
+        super().__init__()
+        self.labels = torch.as_tensor(labels)
+        self.bboxes = torch.as_tensor(bboxes, dtype=torch.float32).reshape(-1, 4)
+        self.scores = torch.as_tensor(scores, dtype=torch.float32)
+
+    def __getitem__(self, keep):
+        return FakeInstances(self.labels[keep], self.bboxes[keep], self.scores[keep])
+
+
+def test_detect_tiled_places_and_merges():
+    array = np.zeros((300, 500, 3), np.uint8)
+
+    def run(tiles):
+        # every tile sees one object at its own top left corner, and the one on the seam at x=250
+        return [FakeInstances([0, 0], [[10, 10, 30, 30], [240 - x, 100, 270 - x, 130]], [0.8, 0.9]) for x in (0, 200)][
+            : len(tiles)
+        ]
+
+    detections = detect_tiled(run, array, 300, 100, batch_size=2)
+    boxes = sorted(map(tuple, detections.bboxes.tolist()))
+    assert boxes == [(10, 10, 30, 30), (210, 10, 230, 30), (240, 100, 270, 130)]
@@ -0,0 +1,59 @@
+import threading
+import time
+
+from dddetailer.writer import ImageWriter
+
+
+def test_zero_threads_saves_inline():
+    writer = ImageWriter(threads=0)
+    saved = []
+    writer.submit("dir", saved.append, 1)
+    assert saved == [1]
+
+
+def test_flush_waits_for_queued_saves():
+    writer = ImageWriter(threads=2)
+    saved = []
+
+    def save(i):
+        time.sleep(0.01)
+        saved.append(i)
+
+    for i in range(6):
+        writer.submit("dir", save, i)
+    writer.flush()
+    assert sorted(saved) == list(range(6))
+
+
+def test_full_queue_saves_on_the_caller_without_overlap():
+    writer = ImageWriter(threads=1, queue_size=1)
+    running = []
+    overlaps = []
+    threads = set()
+
+    def save(i):
+        running.append(i)
+        overlaps.append(len(running) > 1)
+        threads.add(threading.current_thread().name)
+        time.sleep(0.05)
+        running.remove(i)
+
+    for i in range(5):
+        writer.submit("dir", save, i)
+    writer.flush()
+    assert threading.current_thread().name in threads
+    assert not any(overlaps)
+
+
+def test_failed_save_does_not_stop_the_worker(capsys):
+    writer = ImageWriter(threads=1)
+    saved = []
+
+    def broken():
+        raise OSError("disk full")
+
+    writer.submit("dir", broken)
+    writer.submit("dir", saved.append, 1)
+    writer.flush()
+    assert saved == [1]
+    assert "failed to save" in capsys.readouterr().out